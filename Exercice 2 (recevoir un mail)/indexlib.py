@@ -0,0 +1,887 @@
+#!/usr/bin/python3
+
+# Module: indexlib.py
+# Copyright: University of Bordeaux, France (2023).
+
+import os
+import re
+import sys
+import mmap
+import array
+import fcntl
+import heapq
+import bisect
+import struct
+import hashlib
+import datetime
+import itertools
+import email.utils
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+INDEX_FILE = "mail.idx"
+INDEX_LOCK = "mail.idx.lock"   # held by the process writing the index (the index file itself is replaced)
+MAGIC = b"MIX2"
+FIELDS = ('from', 'to', 'subject', 'body')
+TOKEN = re.compile(r"[a-z0-9]+")
+MAXTOKEN = 64       # longer tokens (hashes, encoded data) are not indexed
+DENSE = 64          # results are picked in date order when 1/DENSE of the messages may match
+BLOCK = 128         # docids per block of a posting list (a search decodes the blocks it needs)
+
+# segment layout: MAGIC | body length (u64) | body
+# body layout: first docid (u32) | ndocs (u32) | nterms (u32) | tables | docs | terms
+# tables, read in place (positions are relative to the body):
+#   stamps (i64 x ndocs): timestamp of each doc (-1 without a date)
+#   dates (i64 x ndocs), order (u32 x ndocs): the timestamps sorted, and their docs
+#   hashes (u64 x ndocs), owners (u32 x ndocs): the key hashes sorted, and their docs
+#   docpos (u64 x ndocs): position of each doc
+#   termpos (u64 x nterms): position of each term, the terms being sorted
+# doc: key length (u16) | key | title length (u16) | title
+# term: term length (u16) | term | ndocids (u32) | nblocks (u32) | firsts | lasts | ends | postings
+# postings: docids as varints, each one relative to the previous, cut in blocks
+# of BLOCK docids (firsts, lasts: u32 docids of each block, ends: u32 end of each block)
+# Docs in a segment are numbered from its first docid on. A segment starting at
+# a docid already in the file replaces the segments from that docid on: it is
+# their merge (see index_save).
+SEGMENT = struct.Struct("<4sQ")
+HEAD = struct.Struct("<III")
+TERM = struct.Struct("<II")
+U16 = struct.Struct("<H")
+DOC_TABLES = (('stamps', 'q'), ('dates', 'q'), ('order', 'I'), ('hashes', 'Q'), ('owners', 'I'), ('docpos', 'Q'))
+DOC_SIZE = struct.calcsize("<" + "".join(code for name, code in DOC_TABLES))
+TERM_SIZE = struct.calcsize("<Q")
+
+###############################################
+###               ENCODING                  ###
+###############################################
+
+def encode_postings(docids, last=0):
+    """
+    Encodes a sorted list of document ids as delta varints.
+
+    Parameters:
+        - docids (list): Sorted document ids.
+        - last (int): The document id the first one is relative to.
+
+    Returns:
+        - data (bytearray): The encoded posting list.
+    """
+    data = bytearray()
+    for docid in docids:
+        n = docid - last
+        last = docid
+        while n >= 0x80:
+            data.append((n & 0x7f) | 0x80)
+            n >>= 7
+        data.append(n)
+    return data
+
+def decode_postings(data, last=0):
+    """
+    Decodes a delta varint posting list.
+
+    Parameters:
+        - data (bytes): The encoded posting list.
+        - last (int): The document id the first one is relative to.
+
+    Returns:
+        - docids (list): Sorted document ids.
+    """
+    # every delta but the first fits in one byte (frequent terms): no varint to decode
+    i = 0
+    while i < len(data) - 1 and data[i] & 0x80:
+        i += 1
+    if data and data[i + 1:].isascii():
+        for k, byte in enumerate(data[:i + 1]):
+            last += (byte & 0x7f) << (7 * k)
+        return list(itertools.accumulate(data[i + 1:], initial=last))
+    docids = []
+    n = 0
+    shift = 0
+    for byte in data:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            last += n
+            docids.append(last)
+            n = 0
+            shift = 0
+    return docids
+
+###############################################
+
+def tokenize(text):
+    """
+    Splits a text into lowercase alphanumeric tokens.
+
+    Parameters:
+        - text (str): The text to tokenize.
+
+    Returns:
+        - tokens (list): The tokens found in the text.
+    """
+    if not text:
+        return []
+    return TOKEN.findall(str(text).lower())
+
+def parse_date(text):
+    """
+    Converts a RFC 5322 date or an ISO date (YYYY-MM-DD) into a timestamp.
+
+    Parameters:
+        - text (str): The date to convert.
+
+    Returns:
+        - ts (int): Seconds since the epoch, or None if the date is invalid.
+    """
+    if not text:
+        return None
+    try:
+        date = email.utils.parsedate_to_datetime(str(text))
+    except (TypeError, ValueError, IndexError):
+        try:
+            date = datetime.datetime.fromisoformat(str(text))
+        except ValueError:
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+###############################################
+###                INDEX                    ###
+###############################################
+
+def index_open(path, verbose):
+    """
+    Opens (or creates) the index stored in the given directory.
+
+    Only the segment headers are read: the tables of the segments (the
+    documents in date order, their keys, the sorted terms) are used in
+    place in the memory-mapped file, and posting lists are decoded on
+    demand, so opening does not depend on the size of the index.
+
+    Parameters:
+        - path (str): The index directory.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+
+    Returns:
+        - index (dict): The opened index (ValueError if the file is not an index).
+    """
+    os.makedirs(path, exist_ok=True)
+    index = {'file': os.path.join(path, INDEX_FILE), 'lock': os.path.join(path, INDEX_LOCK), 'map': None}
+    _load(index, verbose)
+    if verbose:
+        print(f"Index: {index['first']} messages, {len(index['segments'])} segments")
+    return index
+
+def _map(index):
+    # map the file again, so that the segments written since are visible
+    # (the segments read before keep the previous map, which stays valid)
+    index['map'] = index['view'] = None
+    if index['size'] > 0:
+        with open(index['file'], 'rb') as f:
+            index['map'] = mmap.mmap(f.fileno(), index['size'], access=mmap.ACCESS_READ)
+        index['view'] = memoryview(index['map'])
+
+def _stat(filename):
+    # what tells that another process changed the file: inode and size
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size
+
+def _locked(index):
+    # exclusive lock, released when the returned file is closed
+    f = open(index['lock'], 'a')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+def _load(index, verbose):
+    filename = index['file']
+    index.update({
+        'stat': _stat(filename),
+        'size': os.path.getsize(filename) if os.path.exists(filename) else 0,
+        'segments': [],     # live segments (see _read)
+        'dead': 0,          # bytes of the segments replaced by a merge
+        'first': 0,         # first docid not saved yet
+        'added': [],        # (timestamp, key, title) of the messages not saved yet
+        'keys': set(),      # their keys
+        'pending': {},      # "field:token" -> [docid, ...] (not saved yet)
+    })
+    _map(index)
+    if index['map'] is None:
+        return
+    if not MAGIC.startswith(index['map'][:len(MAGIC)]):
+        raise ValueError(f"{filename}: not an index, or an older format (remove it and index the mail again)")
+
+    # a segment truncated by an interrupted save is overwritten by the next one,
+    # and so is a segment that does not hold together (the ones after it depend on it)
+    end = _scan(index)
+    if end < index['size']:
+        if verbose:
+            print(f"Index: ignoring {index['size'] - end} trailing bytes")
+        index['size'] = end
+    index['dead'] = index['size'] - sum(segment['size'] for segment in index['segments'])
+    if index['segments']:
+        last = index['segments'][-1]
+        index['first'] = last['first'] + last['ndocs']
+
+def _scan(index):
+    # find the live segments from their headers, stop at the first broken one
+    m = index['map']
+    live = index['segments']
+    pos = 0
+    while pos + SEGMENT.size <= index['size']:
+        magic, length = SEGMENT.unpack_from(m, pos)
+        if magic != MAGIC or pos + SEGMENT.size + length > index['size']:
+            break
+        try:
+            segment = _read(index, pos, SEGMENT.size + length)
+        except ValueError:
+            break
+        kept = len(live)
+        while kept and live[kept - 1]['first'] >= segment['first']:
+            kept -= 1
+        if segment['first'] != (live[kept - 1]['first'] + live[kept - 1]['ndocs'] if kept else 0):
+            break
+        if segment['ndocs'] < sum(s['ndocs'] for s in live[kept:]):
+            break
+        del live[kept:]
+        live.append(segment)
+        pos += segment['size']
+    return pos
+
+def _table(view, p, n, code):
+    # n values (little-endian) at p, read in place, or copied on a big-endian host
+    size = n * struct.calcsize(code)
+    if sys.byteorder == 'little':
+        return view[p:p + size].cast(code)
+    table = array.array(code, bytes(view[p:p + size]))
+    table.byteswap()
+    return table
+
+def _read(index, pos, size):
+    # the header and the tables of a segment (ValueError if they do not fit in it)
+    m = index['map']
+    body = pos + SEGMENT.size
+    end = pos + size
+    if body + HEAD.size > end:
+        raise ValueError("segment header past the segment")
+    first, ndocs, nterms = HEAD.unpack_from(m, body)
+    p = body + HEAD.size
+    if p + ndocs * DOC_SIZE + nterms * TERM_SIZE > end:
+        raise ValueError("segment tables past the segment")
+    view = index['view']
+    segment = {'pos': pos, 'size': size, 'body': body, 'end': end, 'map': m, 'view': view,
+               'first': first, 'ndocs': ndocs, 'nterms': nterms}
+    for name, code in DOC_TABLES:
+        segment[name] = _table(view, p, ndocs, code)
+        p += ndocs * struct.calcsize(code)
+    segment['termpos'] = _table(view, p, nterms, 'Q')
+    p += nterms * TERM_SIZE
+    for table in (segment['docpos'], segment['termpos']):
+        if len(table) and not p <= body + table[0] <= body + table[-1] < end:
+            raise ValueError("segment records past the segment")
+    return segment
+
+def _string(segment, p):
+    # a string record of a segment (length and bytes), and the position after it
+    m = segment['map']
+    if p + U16.size > segment['end']:
+        raise ValueError("record past the segment")
+    n, = U16.unpack_from(m, p)
+    p += U16.size
+    if p + n > segment['end']:
+        raise ValueError("record past the segment")
+    return m[p:p + n], p + n
+
+def _doc(index, docid):
+    # (timestamp, key, title) of a message
+    if docid >= index['first']:
+        return index['added'][docid - index['first']]
+    for segment in reversed(index['segments']):
+        if docid >= segment['first']:
+            break
+    i = docid - segment['first']
+    key, p = _string(segment, segment['body'] + segment['docpos'][i])
+    title, p = _string(segment, p)
+    return segment['stamps'][i], key.decode(), title.decode(errors='replace')
+
+def _dated(index, docids):
+    # (timestamp, docid) of sorted docids
+    segments = index['segments']
+    k = 0
+    for docid in docids:
+        if docid >= index['first']:
+            yield index['added'][docid - index['first']][0], docid
+            continue
+        while docid >= segments[k]['first'] + segments[k]['ndocs']:
+            k += 1
+        yield segments[k]['stamps'][docid - segments[k]['first']], docid
+
+def _hash(key):
+    # 64-bit hash of a key, as sorted in the hashes table
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+def _saved(index, key):
+    # whether a message with this key is in a segment (found by the hash of its key)
+    h = _hash(key)
+    k = key.encode()
+    for segment in index['segments']:
+        hashes = segment['hashes']
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            if _string(segment, segment['body'] + segment['docpos'][segment['owners'][i]])[0] == k:
+                return True
+            i += 1
+    return False
+
+def _terms(segment):
+    # (term, position of its postings) of a segment, in term order
+    body = segment['body']
+    for p in segment['termpos']:
+        yield _string(segment, body + p)
+
+def _find(segment, term):
+    # position of the postings of a term in a segment (binary search), None if absent
+    termpos = segment['termpos']
+    body = segment['body']
+    key = term.encode()
+    lo, hi = 0, len(termpos)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _string(segment, body + termpos[mid])[0] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == len(termpos):
+        return None
+    name, p = _string(segment, body + termpos[lo])
+    return p if name == key else None
+
+def _entry(segment, p):
+    # the posting list at p: (ndocids, firsts, lasts, ends, position of the postings)
+    m = segment['map']
+    if p + TERM.size > segment['end']:
+        raise ValueError("term past the segment")
+    count, nblocks = TERM.unpack_from(m, p)
+    p += TERM.size
+    if not nblocks or p + 3 * 4 * nblocks > segment['end']:
+        raise ValueError("term past the segment")
+    view = segment['view']
+    firsts = _table(view, p, nblocks, 'I')
+    lasts = _table(view, p + 4 * nblocks, nblocks, 'I')
+    ends = _table(view, p + 8 * nblocks, nblocks, 'I')
+    data = p + 12 * nblocks
+    if data + ends[-1] > segment['end']:
+        raise ValueError("postings past the segment")
+    return count, firsts, lasts, ends, data
+
+###############################################
+
+def _text(msg):
+    # the text parts of the message, decoded (attachments are not indexed)
+    texts = []
+    for part in msg.walk():
+        if part.is_multipart() or part.get_content_maintype() != 'text' or part.get_filename():
+            continue
+        payload = part.get_payload(decode=True)
+        if not payload:
+            continue
+        try:
+            texts.append(payload.decode(part.get_content_charset() or 'utf-8', errors='replace'))
+        except LookupError:
+            texts.append(payload.decode('utf-8', errors='replace'))
+    return '\n'.join(texts)
+
+def index_add(index, msg, key=None):
+    """
+    Adds a message to the index (in memory, see index_save).
+
+    Parameters:
+        - index (dict): The opened index.
+        - msg (email.message.Message): The message to index, as received (all its headers and parts).
+        - key (str): A unique key for the message (defaults to its Message-ID, or to a hash
+          of the whole message without one).
+
+    Returns:
+        - added (bool): False if the message was already indexed.
+    """
+    if key is None:
+        key = str(msg['Message-ID'] or '').strip()[:200] or hashlib.sha1(str(msg).encode(errors='replace')).hexdigest()
+    if key in index['keys'] or _saved(index, key):
+        return False
+
+    docid = index['first'] + len(index['added'])
+    ts = parse_date(msg['Date'])
+    ts = ts if ts is not None else -1
+    title = f"{msg['From'] or ''} | {msg['Subject'] or ''}"
+    index['added'].append((ts, key, title[:200]))
+    index['keys'].add(key)
+
+    values = {
+        'from': msg['From'],
+        'to': msg['To'],
+        'subject': msg['Subject'],
+        'body': _text(msg),
+    }
+    for field in FIELDS:
+        for token in set(tokenize(values[field])):
+            if len(token) <= MAXTOKEN:
+                index['pending'].setdefault(f"{field}:{token}", []).append(docid)
+    return True
+
+###############################################
+
+def _pack(code, values):
+    # a table as stored (little-endian)
+    table = array.array(code, values)
+    if sys.byteorder == 'big':
+        table.byteswap()
+    return table.tobytes()
+
+def _segment(first, docs, terms):
+    # body of a segment, from its docs and the (term, docids) sorted by term
+    records = bytearray()
+    docpos = []
+    for ts, key, title in docs:
+        k = key.encode()
+        t = title.encode(errors='replace')[:0xffff]
+        docpos.append(len(records))
+        records += U16.pack(len(k)) + k + U16.pack(len(t)) + t
+
+    entries = bytearray()
+    termpos = []
+    for term, docids in terms:
+        t = term.encode()
+        starts = range(0, len(docids), BLOCK)
+        blocks = [encode_postings(docids[i:i + BLOCK], docids[i - 1] if i else 0) for i in starts]
+        lasts = [docids[min(i + BLOCK, len(docids)) - 1] for i in starts]
+        ends = itertools.accumulate(map(len, blocks))
+        termpos.append(len(entries))
+        entries += U16.pack(len(t)) + t + struct.pack(f"<II{3 * len(blocks)}I", len(docids), len(blocks),
+                                                      *docids[::BLOCK], *lasts, *ends)
+        entries += b''.join(blocks)
+
+    n = len(docs)
+    stamps = [ts for ts, key, title in docs]
+    order = sorted(range(n), key=stamps.__getitem__)
+    keys = sorted((_hash(key), i) for i, (ts, key, title) in enumerate(docs))
+    start = HEAD.size + n * DOC_SIZE + len(termpos) * TERM_SIZE
+    body = bytearray(HEAD.pack(first, n, len(termpos)))
+    body += _pack('q', stamps) + _pack('q', [stamps[i] for i in order]) + _pack('I', order)
+    body += _pack('Q', [h for h, i in keys]) + _pack('I', [i for h, i in keys])
+    body += _pack('Q', [start + p for p in docpos])
+    body += _pack('Q', [start + len(records) + p for p in termpos])
+    return body + records + entries
+
+def _append(index, body):
+    # write a segment at the end of the index (over what an interrupted save left there)
+    pos = index['size']
+    with open(index['file'], 'r+b' if os.path.exists(index['file']) else 'wb') as f:
+        f.truncate(pos)
+        f.seek(pos)
+        f.write(SEGMENT.pack(MAGIC, len(body)) + body)
+        f.flush()
+        os.fsync(f.fileno())
+        st = os.fstat(f.fileno())
+    index['stat'] = st.st_ino, st.st_size
+    index['size'] += SEGMENT.size + len(body)
+    _map(index)
+    return _read(index, pos, SEGMENT.size + len(body))
+
+def _merge(index, k, verbose):
+    # replace the k newest segments by their merge, appended to the file (see _scan)
+    segments = index['segments']
+    tail = segments[-k:]
+    docs = [_doc(index, docid) for docid in range(tail[0]['first'], index['first'])]
+
+    def entries(i, segment):
+        for term, p in _terms(segment):
+            yield term, i, p
+
+    def terms():
+        # the terms of the k segments in order, and their docids (older segments first)
+        for term, group in itertools.groupby(heapq.merge(*itertools.starmap(entries, enumerate(tail))),
+                                             key=lambda entry: entry[0]):
+            docids = []
+            for _, i, p in group:
+                count, firsts, lasts, ends, data = _entry(tail[i], p)
+                docids += decode_postings(tail[i]['map'][data:data + ends[-1]])
+            yield term.decode(), docids
+
+    segment = _append(index, _segment(tail[0]['first'], docs, terms()))
+    index['dead'] += sum(s['size'] for s in tail)
+    segments[-k:] = [segment]
+    if verbose:
+        print(f"Index: merged {k} segments ({len(docs)} messages)")
+
+def _rewrite(index, verbose):
+    # copy the live segments to a new file, without the merged ones
+    tmp = index['file'] + '.tmp'
+    with open(tmp, 'wb') as f:
+        for segment in index['segments']:
+            f.write(segment['map'][segment['pos']:segment['end']])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, index['file'])
+    if verbose:
+        print(f"Index: dropped {index['dead']} bytes of merged segments")
+    _load(index, verbose)
+
+###############################################
+
+def _reload(index, verbose):
+    # another process saved or compacted the index since it was loaded: load it
+    # again, and number the messages not saved yet after the ones it saved
+    first = index['first']
+    added = index['added']
+    pending = index['pending']
+    _load(index, verbose)
+    renumber = {}
+    for docid, (ts, key, title) in enumerate(added, first):
+        if _saved(index, key):
+            continue    # saved by the other process too
+        renumber[docid] = index['first'] + len(index['added'])
+        index['added'].append((ts, key, title))
+        index['keys'].add(key)
+    for term, docids in pending.items():
+        docids = [renumber[docid] for docid in docids if docid in renumber]
+        if docids:
+            index['pending'][term] = docids
+    if verbose:
+        print("Index: changed by another process, reloaded")
+
+def _save(index, verbose):
+    # index_save, with the lock held and the index up to date
+    added = index['added']
+    if not added:
+        return 0
+
+    segment = _append(index, _segment(index['first'], added, sorted(index['pending'].items())))
+    index['segments'].append(segment)
+    index.update({'first': index['first'] + len(added), 'added': [], 'keys': set(), 'pending': {}})
+    if verbose:
+        print(f"Index: saved {len(added)} messages")
+
+    segments = index['segments']
+    k, n = 1, segments[-1]['ndocs']
+    while k < len(segments) and segments[-k - 1]['ndocs'] <= n:
+        k += 1
+        n += segments[-k]['ndocs']
+    if k > 1:
+        _merge(index, k, verbose)
+    if index['dead'] > index['size'] - index['dead']:
+        _rewrite(index, verbose)
+    return len(added)
+
+def _update(index, verbose):
+    # with the lock held: catch up with what other processes wrote
+    if _stat(index['file']) != index['stat']:
+        _reload(index, verbose)
+
+def index_save(index, verbose):
+    """
+    Appends the messages added since the last save as a new segment.
+
+    The newest segments are then merged as long as the segment before
+    them is not bigger than they are together, so an index saved after
+    every few messages keeps a number of segments logarithmic in its
+    size. The file is rewritten when the replaced segments take more
+    room than the live ones.
+
+    Several processes may write the same index: the save holds a lock,
+    and first reloads the index if another process changed it.
+
+    Parameters:
+        - index (dict): The opened index.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+
+    Returns:
+        - n (int): The number of messages written.
+    """
+    if not index['added']:
+        return 0
+    with _locked(index):
+        _update(index, verbose)
+        return _save(index, verbose)
+
+def index_compact(index, verbose):
+    """
+    Merges all the segments of the index into one and rewrites the file.
+
+    Parameters:
+        - index (dict): The opened index.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+    """
+    with _locked(index):
+        _update(index, verbose)
+        _save(index, verbose)
+        if len(index['segments']) > 1:
+            _merge(index, len(index['segments']), verbose)
+        if index['dead']:
+            _rewrite(index, verbose)
+
+###############################################
+
+def index_close(index, verbose):
+    """
+    Saves the pending messages and releases the index.
+
+    Parameters:
+        - index (dict): The opened index.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+    """
+    index_save(index, verbose)
+    # the map is released with the tables read from it
+    index['segments'] = []
+    index['map'] = None
+
+###############################################
+###                SEARCH                   ###
+###############################################
+
+class _Postings:
+    """
+    The docids of a term: the posting lists of the segments holding it,
+    then the messages not saved yet. A membership test only decodes the
+    block that may hold the docid.
+    """
+
+    def __init__(self, index, term):
+        self.parts = []     # (ndocids, firsts, lasts, ends, postings position, map); the docids for the pending ones
+        self.bounds = []    # last docid of each part
+        self.blocks = {}    # (part, block) -> docids
+        self.count = 0
+        for segment in index['segments']:
+            p = _find(segment, term)
+            if p is not None:
+                count, firsts, lasts, ends, data = _entry(segment, p)
+                self.parts.append((count, firsts, lasts, ends, data, segment['map']))
+                self.bounds.append(lasts[-1])
+                self.count += count
+        docids = index['pending'].get(term)
+        if docids:
+            self.parts.append((len(docids), docids[:1], docids[-1:], None, docids, None))
+            self.bounds.append(docids[-1])
+            self.count += len(docids)
+
+    def _decode(self, i, j):
+        count, firsts, lasts, ends, data, m = self.parts[i]
+        if ends is None:
+            return data
+        if j:
+            return decode_postings(m[data + ends[j - 1]:data + ends[j]], lasts[j - 1])
+        return decode_postings(m[data:data + ends[0]])
+
+    def _full(self, i, j):
+        # whether a block holds every docid from its first to its last (nothing to decode)
+        count, firsts, lasts = self.parts[i][:3]
+        size = BLOCK if j < len(firsts) - 1 else count - BLOCK * j
+        return lasts[j] - firsts[j] + 1 == size
+
+    def __contains__(self, docid):
+        i = bisect.bisect_left(self.bounds, docid)
+        if i == len(self.parts):
+            return False
+        count, firsts, lasts = self.parts[i][:3]
+        j = bisect.bisect_left(lasts, docid)
+        if docid < firsts[j]:
+            return False
+        if self._full(i, j):
+            return True
+        block = self.blocks.get((i, j))
+        if block is None:
+            block = self.blocks[(i, j)] = self._decode(i, j)
+        return block[bisect.bisect_left(block, docid)] == docid
+
+    def __iter__(self):
+        for count, firsts, lasts, ends, data, m in self.parts:
+            yield from data if ends is None else decode_postings(m[data:data + ends[-1]])
+
+    def missing(self, ndocs):
+        # the docids below ndocs that are not in the list: only the blocks with gaps are decoded
+        following = 0
+        for i, (count, firsts, lasts, ends, data, m) in enumerate(self.parts):
+            for j in range(len(firsts)):
+                if self._full(i, j):
+                    yield from range(following, firsts[j])
+                else:
+                    for docid in self._decode(i, j):
+                        yield from range(following, docid)
+                        following = docid + 1
+                following = lasts[j] + 1
+        yield from range(following, ndocs)
+
+def _lookup(index, field, value):
+    # all the tokens of the value must appear in the field (or any field):
+    # one clause per token, the posting lists of the fields that hold it
+    fields = (field,) if field else FIELDS
+    clauses = []
+    for token in tokenize(value):
+        clause = [_Postings(index, f"{f}:{token}") for f in fields]
+        clause.sort(key=lambda postings: postings.count, reverse=True)   # the likeliest field first
+        clauses.append([postings for postings in clause if postings.count])
+    return clauses
+
+def _holds(clause, docid):
+    return any(docid in postings for postings in clause)
+
+def _count(clause):
+    # at most that many messages hold the clause
+    return sum(postings.count for postings in clause)
+
+###############################################
+
+def _date_filter(item):
+    # after:DATE, before:DATE, date:DAY or date:FROM..TO (either bound may be empty)
+    field, _, value = item.partition(':')
+    low, high = None, None
+    if field == 'after':
+        low = parse_date(value)
+    elif field == 'before':
+        high = parse_date(value)
+    elif '..' in value:
+        start, _, end = value.partition('..')
+        low = parse_date(start)
+        high = parse_date(end)
+    else:
+        low = parse_date(value)
+        if low is not None:
+            high = low + 86400
+    return low, high
+
+def _in_range(ts, low, high):
+    # messages without a date are only found without an upper bound
+    return (low is None or ts >= low) and (high is None or 0 <= ts < high)
+
+def _match(group, ts, docid):
+    clauses, excluded, low, high = group
+    return (_in_range(ts, low, high) and all(_holds(clause, docid) for clause in clauses)
+            and not any(all(_holds(clause, docid) for clause in item) for item in excluded))
+
+def _source(group, ndocs):
+    # where the matches of a group are: (how many at most, their docids in order,
+    # the group left to check on them), None if any message may match
+    clauses, excluded, low, high = group
+    if clauses:
+        # the rarest term (the clauses are sorted)
+        return _count(clauses[0]), heapq.merge(*clauses[0]), (clauses[1:], excluded, low, high)
+    # without a positive term, the messages that do not hold a frequent term
+    best = None
+    for item in excluded:
+        if len(item) == 1 and item[0]:
+            postings = max(item[0], key=lambda postings: postings.count)
+            if best is None or postings.count > best.count:
+                best = postings
+    return (ndocs - best.count, best.missing(ndocs), group) if best else None
+
+def _newest(index, low, high):
+    # (timestamp, docid) of the messages within the dates, most recent first:
+    # the date tables of the segments and the pending messages, merged
+    streams = []
+    for segment in index['segments']:
+        dates, order, first = segment['dates'], segment['order'], segment['first']
+        start = 0 if low is None else bisect.bisect_left(dates, low)
+        stop = len(dates) if high is None else bisect.bisect_left(dates, high)
+        streams.append(zip(dates[start:stop][::-1], map(first.__add__, order[start:stop][::-1])))
+    streams.append(sorted(((ts, docid) for docid, (ts, key, title) in enumerate(index['added'], index['first'])),
+                          reverse=True))
+    return heapq.merge(*streams, reverse=True)
+
+def _walk(index, groups, limit):
+    # walk the messages from the most recent one, within the dates of the query
+    lows = [low for clauses, excluded, low, high in groups]
+    highs = [high for clauses, excluded, low, high in groups]
+    low = None if None in lows else min(lows)
+    high = None if None in highs else max(highs)
+
+    results = []
+    if limit == 0:
+        return results
+    for ts, docid in _newest(index, low, high):
+        if any(_match(group, ts, docid) for group in groups):
+            results.append((ts, docid))
+            if len(results) == limit:
+                break
+    return results
+
+def index_search(index, query, limit=None):
+    """
+    Searches the index.
+
+    The query is a list of terms separated by spaces, all of which must
+    match. "OR" separates alternatives, "-" or "NOT" negates a term.
+    A term may be restricted to a field (from:, to:, subject:, body:).
+    Dates are filtered with after:YYYY-MM-DD, before:YYYY-MM-DD or
+    date:YYYY-MM-DD..YYYY-MM-DD.
+
+    The messages holding the rarest term of an alternative (or, with
+    negations only, the messages not holding a frequent term) are checked
+    against the other terms, which only decodes the blocks of postings
+    holding them. Queries without such a term and queries that match many
+    messages are answered by walking the messages from the most recent
+    one, which stops as soon as the limit is reached.
+
+    Parameters:
+        - index (dict): The opened index.
+        - query (str): The query.
+        - limit (int): The maximum number of results (None for all).
+
+    Returns:
+        - results (list): Matching (docid, timestamp, key, title), most recent first.
+    """
+    groups = []
+
+    for group in re.split(r"\s+OR\s+", query.strip()):
+        clauses = []
+        excluded = []
+        low, high = None, None
+        negate = False
+        for item in group.split():
+            if item == 'NOT':
+                negate = True
+                continue
+            if item.startswith('-') and len(item) > 1:
+                negate, item = True, item[1:]
+            field, sep, value = item.partition(':')
+            if sep and field in ('after', 'before', 'date'):
+                lo, hi = _date_filter(item)
+                if lo is not None: low = lo if low is None else max(low, lo)
+                if hi is not None: high = hi if high is None else min(high, hi)
+                negate = False
+                continue
+            if sep and field in FIELDS:
+                found = _lookup(index, field, value)
+            else:
+                found = _lookup(index, None, item)
+            if negate:
+                if found:
+                    excluded.append(found)
+            else:
+                clauses += found or [[]]   # a term without a token matches nothing
+            negate = False
+        clauses.sort(key=_count)
+        groups.append((clauses, excluded, low, high))
+
+    ndocs = index['first'] + len(index['added'])
+    sources = [_source(group, ndocs) for group in groups]
+    if None in sources or limit is not None and sum(size for size, docids, rest in sources) * DENSE >= ndocs:
+        results = _walk(index, groups, limit)
+    else:
+        matches = set()
+        for size, docids, rest in sources:
+            for ts, docid in _dated(index, docids):
+                if _match(rest, ts, docid):
+                    matches.add((ts, docid))
+        if limit is not None and len(matches) > limit:
+            results = heapq.nlargest(limit, matches)
+        else:
+            results = sorted(matches, reverse=True)
+    return [(docid,) + _doc(index, docid) for ts, docid in results]
+
+### EOF
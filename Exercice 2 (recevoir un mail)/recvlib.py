@@ -8,6 +8,8 @@ import socket
 import base64
 import ssl
 import email
+import email.policy
+import time
 
 ###############################################
 ###                DEFAULT                  ###
@@ -16,12 +18,67 @@ import email
 DOMAIN = "pouet.com"
 TIMEOUT = 2
 MAXLINE = 1024
+RECVSIZE = 65536    # bytes asked per recv for a response
+
+## watch mode: poll interval in seconds, grows while the mailbox is idle
+POLL_MIN = 2
+POLL_MAX = 60
+POLL_BACKOFF = 2
+RETR_TRIES = 3      # failed RETR of a message before it is skipped
 
 ###############################################
 ###               POP3/CLIENT               ###
 ###############################################
 
-def pop3_connect(host, port, secure, verbose):
+def pop3_deadline(s, end):
+    """
+    Sets the socket timeout to the time left before a deadline.
+
+    Parameters:
+        - s (socket): The socket connected to the POP3 server.
+        - end (float): The deadline (time.monotonic() based), None to keep the timeout.
+
+    Raises:
+        - socket.timeout: If the deadline has passed.
+    """
+    if end is None:
+        return
+    left = end - time.monotonic()
+    if left <= 0:
+        raise socket.timeout("deadline exceeded")
+    s.settimeout(left)
+
+def pop3_reply(s, multiline, end=None):
+    """
+    Receives a complete response from the POP3 server.
+
+    Parameters:
+        - s (socket): The socket connected to the POP3 server.
+        - multiline (bool): Indicates whether a successful response ends with a "." line.
+        - end (float): The deadline for the whole response (None: TIMEOUT for each recv).
+
+    Returns:
+        - ans (str): Server response (8-bit text is kept as surrogates, see email.message_from_string).
+    """
+    data = bytearray()
+    while True:
+        pop3_deadline(s, end)
+        chunk = s.recv(RECVSIZE)
+        if not chunk:
+            break
+        data += chunk
+        # errors are always a single line
+        if not multiline or not data.startswith(b'+OK'):
+            if b'\r\n' in data:
+                break
+        elif data.endswith(b'\r\n.\r\n'):
+            break
+    # a message is not always UTF-8 (latin-1, raw 8-bit): keep its bytes as they are
+    return data.decode(errors='surrogateescape')
+
+###############################################
+
+def pop3_connect(host, port, secure, verbose, trace=None):
     """
     Connects to the POP3 server.
 
@@ -30,6 +87,7 @@ def pop3_connect(host, port, secure, verbose):
         - port (int): The port of the POP3 server.
         - secure (bool): Indicates whether the connection should be secure.
         - verbose (bool): Indicates whether debug messages should be displayed.
+        - trace (str): A file to record the session in (see tracelib), None to not record.
 
     Returns:
         - s (socket): The socket connected to the POP3 server.
@@ -41,8 +99,19 @@ def pop3_connect(host, port, secure, verbose):
         else:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        if trace:
+            import tracelib
+            s = tracelib.trace_socket(s, trace, 'POP3')
+
+        s.settimeout(TIMEOUT)
         s.connect((host, port))
 
+        # the server speaks first, its greeting must not be taken for the reply to USER
+        greeting = pop3_reply(s, False)
+        if not greeting.startswith("+OK"):
+            s.close()
+            raise ConnectionError(greeting.strip() or "no greeting")
+
         if verbose:
             print(f"Connected to {host}:{port}{' securely' if secure else ''}")
 
@@ -74,7 +143,7 @@ def pop3_auth(s, login, password, verbose):
     try:
         # Send the username
         s.send(f"USER {login}\r\n".encode())
-        response = s.recv(MAXLINE).decode()
+        response = pop3_reply(s, False)
 
         if verbose:
             print(response)
@@ -82,7 +151,7 @@ def pop3_auth(s, login, password, verbose):
         if response.startswith("+OK"):
             # Send the password
             s.send(f"PASS {password}\r\n".encode())
-            response = s.recv(MAXLINE).decode()
+            response = pop3_reply(s, False)
 
             if verbose:
                 print(response)
@@ -116,7 +185,7 @@ def pop3_noop(s, verbose):
     try:
         # Send the NOOP command
         s.send(b"NOOP\r\n")
-        response = s.recv(MAXLINE).decode()
+        response = pop3_reply(s, False)
 
         if verbose:
             print(response)
@@ -150,7 +219,7 @@ def pop3_stat(s, verbose):
     try:
         # Send the STAT command
         s.send(b"STAT\r\n")
-        response = s.recv(MAXLINE).decode()
+        response = pop3_reply(s, False)
 
         if verbose:
             print(response)
@@ -166,13 +235,15 @@ def pop3_stat(s, verbose):
 
 ###############################################
 
-def pop3_list(s, verbose):
+def pop3_list(s, verbose, deadline=None):
     """
     Sends the LIST command to the POP3 server.
 
     Parameters:
         - s (socket): The socket connected to the POP3 server.
         - verbose (bool): Indicates whether debug messages should be displayed.
+        - deadline (float): The time allowed for the whole listing, in seconds
+          (None: TIMEOUT for each recv, however long the listing).
 
     Returns:
         - ok (bool): Server status (True if the command is successful, False otherwise).
@@ -183,10 +254,11 @@ def pop3_list(s, verbose):
     ans = ""
     info = ""
 
+    end = time.monotonic() + deadline if deadline is not None else None
     try:
         # Send the LIST command
         s.send(b"LIST\r\n")
-        response = s.recv(MAXLINE).decode()
+        response = pop3_reply(s, True, end)
 
         if verbose:
             print(response)
@@ -195,24 +267,62 @@ def pop3_list(s, verbose):
             ok = True
             ans = response
             info = response
-
-            # Receive and parse the list of message information
-            '''
-            response = s.recv(MAXLINE).decode()
-                if response == ".":
-                    break
-                message_info.append(response)
-
-            info = "\n".join(message_info)
-            '''
     except Exception as e:
         if verbose:
             print(f"LIST command failed: {str(e)}")
+    finally:
+        if end is not None:
+            s.settimeout(TIMEOUT)
 
     return ok, ans, info
 
 ###############################################
 
+def pop3_uidl(s, verbose, deadline=None):
+    """
+    Sends the UIDL command to the POP3 server.
+
+    Parameters:
+        - s (socket): The socket connected to the POP3 server.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - deadline (float): The time allowed for the whole listing, in seconds
+          (None: TIMEOUT for each recv, however long the listing).
+
+    Returns:
+        - ok (bool): Server status (True if the command is successful, False otherwise).
+        - ans (str): Server response ("" if the session failed).
+        - uids (list): The (rank, unique id) of the messages.
+    """
+    ok = False
+    ans = ""
+    uids = []
+
+    end = time.monotonic() + deadline if deadline is not None else None
+    try:
+        # Send the UIDL command
+        s.send(b"UIDL\r\n")
+        ans = pop3_reply(s, True, end)
+
+        if verbose:
+            print(ans)
+
+        if ans.startswith("+OK"):
+            for line in ans.split('\r\n')[1:]:
+                fields = line.split()
+                if len(fields) == 2 and fields[0].isdigit():
+                    uids.append((int(fields[0]), fields[1]))
+            ok = True
+    except Exception as e:
+        if verbose:
+            print(f"UIDL command failed: {str(e)}")
+    finally:
+        if end is not None:
+            s.settimeout(TIMEOUT)
+
+    return ok, ans, uids
+
+###############################################
+
 def get_from(lines):
     return_path = None
     # Iterate through the lines to find the "Return-path:" line
@@ -283,7 +393,7 @@ def get_payload(lines):
 
     return extracted_text
 
-def pop3_retr(s, rank, verbose):
+def pop3_retr(s, rank, verbose, deadline=None):
     """
     Sends the RETR command to the POP3 server to retrieve a message.
 
@@ -291,6 +401,8 @@ def pop3_retr(s, rank, verbose):
         - s (socket): The socket connected to the POP3 server.
         - rank (int): The rank of the message to retrieve.
         - verbose (bool): Indicates whether debug messages should be displayed.
+        - deadline (float): The time allowed for the whole transfer, in seconds
+          (None: TIMEOUT for each recv, however long the transfer).
 
     Returns:
         - ok (bool): Server status (True if the command is successful, False otherwise).
@@ -301,12 +413,13 @@ def pop3_retr(s, rank, verbose):
     ans = ""
     msg = None
 
+    end = time.monotonic() + deadline if deadline is not None else None
     try:
         # Send the RETR command to the server
         s.send(f"RETR {rank}\r\n".encode())
 
-        # Receive the server's response
-        ans = s.recv(MAXLINE).decode()
+        # Receive the server's response, up to the final "." line
+        ans = pop3_reply(s, True, end)
 
         # Check if the response starts with "+OK"
         if ans.startswith("+OK"):
@@ -327,9 +440,29 @@ def pop3_retr(s, rank, verbose):
     except Exception as e:
         if verbose:
             print(f"Error: {e}")
+    finally:
+        if end is not None:
+            s.settimeout(TIMEOUT)
 
     return ok, ans, msg
 
+def pop3_message(ans):
+    """
+    Parses the whole message carried by a response to RETR.
+
+    Parameters:
+        - ans (str): Server response, up to the final "." line.
+
+    Returns:
+        - msg (email.message.EmailMessage): The message, with all its headers and parts.
+    """
+    lines = ans.split('\r\n')[1:]
+    if lines[-2:] == ['.', '']:
+        lines = lines[:-2]
+    # undo the byte-stuffing of the lines starting with "."
+    lines = [line[1:] if line.startswith('.') else line for line in lines]
+    return email.message_from_string('\r\n'.join(lines) + '\r\n', policy=email.policy.default)
+
 ###############################################
 
 def pop3_dele(s, rank, verbose):
@@ -351,7 +484,7 @@ def pop3_dele(s, rank, verbose):
     try:
         # Send the DELE command to mark a message for deletion
         s.send(f"DELE {rank}\r\n".encode())
-        response = s.recv(MAXLINE).decode()
+        response = pop3_reply(s, False)
 
         if verbose:
             print(response)
@@ -385,7 +518,7 @@ def pop3_quit(s, verbose):
     try:
         # Send the QUIT command to terminate the connection
         s.send(b"QUIT\r\n")
-        response = s.recv(MAXLINE).decode()
+        response = pop3_reply(s, False)
 
         if verbose:
             print(response)
@@ -398,4 +531,226 @@ def pop3_quit(s, verbose):
             print(f"QUIT command failed: {str(e)}")
 
     return ok, ans
+
+###############################################
+###               POP3/WATCH                ###
+###############################################
+
+def pop3_parse_stat(ans):
+    """
+    Parses the response to the STAT command.
+
+    Parameters:
+        - ans (str): Server response (e.g. "+OK 2 320").
+
+    Returns:
+        - count (int): The number of messages (None if the response is invalid).
+        - size (int): The size of the maildrop in octets (None if the response is invalid).
+    """
+    try:
+        fields = ans.split()
+        return int(fields[1]), int(fields[2])
+    except (IndexError, ValueError):
+        return None, None
+
+###############################################
+
+def pop3_session(host, port, secure, login, password, verbose, trace=None):
+    """
+    Connects and authenticates to the POP3 server.
+
+    Parameters:
+        - host (str): The address of the POP3 server.
+        - port (int): The port of the POP3 server.
+        - secure (bool): Indicates whether the connection should be secure.
+        - login (str): The username for authentication.
+        - password (str): The password for authentication.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - trace (str): A file to record the session in (see tracelib), None to not record.
+
+    Returns:
+        - s (socket): The authenticated socket (None on failure).
+    """
+    s = pop3_connect(host, port, secure, verbose, trace)
+    if not s:
+        return None
+    ok, ans = pop3_auth(s, login, password, verbose)
+    if not ok:
+        s.close()
+        return None
+    return s
+
+def _pop3_close(s, verbose):
+    # leave politely, the session may already be dead
+    pop3_quit(s, verbose)
+    try:
+        s.close()
+    except OSError:
+        pass
+
+###############################################
+
+def pop3_watch(host, port, secure, login, password, verbose,
+               seen=None, poll_min=POLL_MIN, poll_max=POLL_MAX, trace=None, idle=None):
+    """
+    Watches the mailbox and yields the new messages as they arrive.
+
+    The session is kept open and polled with STAT: a change of the message
+    count or size is detected without retrieving anything. The new messages
+    are then told apart by their unique id (UIDL), since a message may
+    arrive while another one is deleted, or by rank if the server does not
+    support UIDL. A message that cannot be retrieved RETR_TRIES times is
+    skipped with a warning, so it does not hold back the next ones. Many servers
+    only refresh the maildrop at login, so once the mailbox has been idle
+    long enough for the interval to reach poll_max, a new session is
+    opened right after the STAT of the old one and polled as well. If it
+    finds mail that the old session still misses when asked again, the
+    server is known to snapshot the maildrop and every poll reconnects.
+    If an old session sees new mail on its own, the server is known to be
+    live and the session is kept until it fails. The interval is reset to
+    poll_min on activity and multiplied by POLL_BACKOFF on every idle poll.
+
+    Parameters:
+        - host (str): The address of the POP3 server.
+        - port (int): The port of the POP3 server.
+        - secure (bool): Indicates whether the connection should be secure.
+        - login (str): The username for authentication.
+        - password (str): The password for authentication.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - seen (int): The number of messages already seen (None to start from the current count).
+        - poll_min (float): The shortest interval between two polls, in seconds.
+        - poll_max (float): The longest interval between two polls, in seconds.
+        - trace (str): A file to record the sessions in (see tracelib), None to not record.
+        - idle (function): Called before each wait, once the new mail has been yielded (None for no call).
+
+    Yields:
+        - rank (int): The rank of the new message.
+        - msg (email.message.Message): The new message.
+        - ans (str): Server response to RETR (see pop3_message).
+    """
+    s = None
+    count, size = seen, None
+    interval = poll_min
+    snapshot = None     # None: unknown, True: refreshed at login only, False: live
+    known = None        # unique ids of the messages seen (None: not listed yet)
+    uidl = True         # False once the server has refused UIDL: new mail is found by rank
+    failures = {}       # failed RETR per message (unique id, or rank)
+
+    try:
+        while True:
+            new = s is None
+            if new:
+                s = pop3_session(host, port, secure, login, password, verbose, trace)
+                if s is None:
+                    time.sleep(interval)
+                    interval = min(interval * POLL_BACKOFF, poll_max)
+                    continue
+
+            ok, ans = pop3_stat(s, verbose)
+            n, total = pop3_parse_stat(ans) if ok else (None, None)
+            if n is None:
+                # session lost: reconnect, the interval is kept
+                _pop3_close(s, verbose)
+                s = None
+                time.sleep(interval)
+                continue
+
+            if n == count and snapshot is None and not new and interval >= poll_max:
+                # idle for long: would a new session see more than this one?
+                fresh = pop3_session(host, port, secure, login, password, verbose, trace)
+                ok, ans = pop3_stat(fresh, verbose) if fresh else (False, "")
+                m, mtotal = pop3_parse_stat(ans) if ok else (None, None)
+                if m is not None:
+                    if m > n:
+                        # the mail may have arrived between the two STATs: ask the old session again
+                        ok, ans = pop3_stat(s, verbose)
+                        again, _ = pop3_parse_stat(ans) if ok else (None, None)
+                        if again is not None:
+                            snapshot = again < m
+                            if verbose:
+                                print(f"Server refreshes the maildrop {'at login only' if snapshot else 'live'}")
+                    _pop3_close(s, verbose)
+                    s, n, total, new = fresh, m, mtotal, True
+                elif fresh is not None:
+                    _pop3_close(fresh, verbose)
+
+            new_mail = []
+            if (n, total) != (count, size):
+                # something changed: list the messages by unique id, when the
+                # same poll sees a deletion and an arrival the ranks would hide it
+                ok, ans, uids = pop3_uidl(s, verbose) if uidl else (False, "-ERR", [])
+                if not ok and not ans.startswith("-ERR"):
+                    # session lost: reconnect, the interval is kept
+                    _pop3_close(s, verbose)
+                    s = None
+                    time.sleep(interval)
+                    continue
+                if ok:
+                    if known is None:
+                        # first listing: the first `seen` messages are known (all if None)
+                        known = {uid for rank, uid in uids if count is None or rank <= count}
+                    new_mail = [(rank, uid) for rank, uid in uids if uid not in known]
+                    # forget the messages deleted since
+                    listed = {uid for rank, uid in uids}
+                    known &= listed
+                    failures = {uid: tries for uid, tries in failures.items() if uid in listed}
+                else:
+                    if uidl and verbose:
+                        print("UIDL not supported, new mail is found by rank")
+                    uidl = False
+                    if count is None or n < count:
+                        # first poll, or messages deleted by another client
+                        count = n
+                    elif n == count and size is not None and verbose:
+                        print(f"Mailbox changed without new messages ({size} -> {total} octets)")
+                    new_mail = [(rank, rank) for rank in range(count + 1, n + 1)]
+
+            done = True
+            if new_mail:
+                if snapshot is None and not new:
+                    # a session polled before the mail arrived has seen it
+                    snapshot = False
+                    if verbose:
+                        print("Server refreshes the maildrop live")
+                for rank, key in new_mail:
+                    ok, ans, msg = pop3_retr(s, rank, verbose)
+                    if not ok:
+                        failures[key] = failures.get(key, 0) + 1
+                        if failures[key] < RETR_TRIES:
+                            # the reply may be left half read: try again on a new session
+                            done = False
+                            break
+                        reason = ans.split('\r\n')[0] or "no reply"
+                        print(f"[Warning retr] message {rank} skipped after {RETR_TRIES} attempts: {reason}")
+                    failures.pop(key, None)
+                    if known is not None:
+                        known.add(key)
+                    else:
+                        count = rank
+                    if ok:
+                        yield rank, msg, ans
+                interval = poll_min
+            else:
+                interval = min(interval * POLL_BACKOFF, poll_max)
+
+            if done:
+                count, size = n, total
+            else:
+                # listed again at the next poll
+                size = None
+                _pop3_close(s, verbose)
+                s = None
+
+            if snapshot and s is not None:
+                # the session would never see new mail
+                _pop3_close(s, verbose)
+                s = None
+
+            if idle:
+                idle()
+            time.sleep(interval)
+    finally:
+        if s is not None:
+            _pop3_close(s, verbose)
+
 ### EOF
@@ -3,9 +3,11 @@
 # Program: recvmail.py
 # Copyright: University of Bordeaux, France (2023).
 
+import os
 import sys
 import argparse
 import recvlib
+import indexlib
 import email.message
 
 ###############################################
@@ -22,6 +24,9 @@ POP3_PORT_SECURE = 10995   # secure over SSL/TLS
 LOGIN="tutu"
 PASSWORD="tutu"
 
+## index config (watch mode): messages indexed between two saves, at most
+INDEX_BATCH = 100
+
 ###############################################
 ###                ERROR                    ###
 ###############################################
@@ -43,6 +48,12 @@ if __name__ == "__main__":
     parser.add_argument('-S', '--secure', action='store_true', default=False, help='secure mode')
     parser.add_argument('-l', '--login', type=str, default=LOGIN, help='user login')
     parser.add_argument('-p', '--password', type=str, default=PASSWORD, help='user password')
+    parser.add_argument('-i', '--index', type=str, default=None, help='index retrieved mail in this directory')
+    parser.add_argument('-w', '--watch', action='store_true', default=False, help='watch mode: print new mail as it arrives')
+    parser.add_argument('--poll-min', type=float, default=recvlib.POLL_MIN, help='watch mode: shortest poll interval (s)')
+    parser.add_argument('--poll-max', type=float, default=recvlib.POLL_MAX, help='watch mode: longest poll interval (s)')
+    parser.add_argument('-d', '--deadline', type=float, default=None, help='time allowed for list/retr (s)')
+    parser.add_argument('--trace', type=str, default=None, help='record the session in this file (see replay.py)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose')
     #parser.add_argument('cmd', type=str, choices=['noop', 'stat', 'list', 'retr', 'dele'], help='command')
     parser.add_argument('-cmd', type=str, choices=['noop', 'stat', 'list', 'retr', 'dele'], default='retr', help='command')
@@ -55,8 +66,37 @@ if __name__ == "__main__":
     ## print arguments
     if args.verbose: print("args:", args.__dict__)
 
+    ## tracelib is shared with the SMTP client, in the parent directory
+    if args.trace: sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+    ## watch mode (runs until interrupted)
+    if args.watch:
+        try:
+            index = indexlib.index_open(args.index, args.verbose) if args.index else None
+        except (OSError, ValueError) as e:
+            error("index", str(e))
+
+        def save():
+            # the mail found by a poll is saved at once, before waiting for more
+            if index: indexlib.index_save(index, args.verbose)
+
+        try:
+            for rank, msg, ans in recvlib.pop3_watch(args.host, args.port, args.secure, args.login, args.password,
+                                                     args.verbose, poll_min=args.poll_min, poll_max=args.poll_max,
+                                                     trace=args.trace, idle=save):
+                print(f"[Mail {rank}]")
+                print(msg, flush=True)
+                if index:
+                    indexlib.index_add(index, recvlib.pop3_message(ans))
+                    if len(index['added']) >= INDEX_BATCH:
+                        save()
+        except KeyboardInterrupt:
+            pass
+        if index: indexlib.index_close(index, args.verbose)
+        sys.exit(0)
+
     ## start pop3 client
-    s = recvlib.pop3_connect(args.host, args.port, args.secure, args.verbose)
+    s = recvlib.pop3_connect(args.host, args.port, args.secure, args.verbose, args.trace)
     if not s: error("connect", "")
 
     ## auth (required)
@@ -69,11 +109,18 @@ if __name__ == "__main__":
     if(args.cmd == 'stat'):
         ok, ans = recvlib.pop3_stat(s, args.verbose)
     if(args.cmd == 'list'):
-        ok, ans, info = recvlib.pop3_list(s, args.verbose)
+        ok, ans, info = recvlib.pop3_list(s, args.verbose, args.deadline)
         print(info)
     if(args.cmd == 'retr'):
-        ok, ans, msg = recvlib.pop3_retr(s, args.rank, args.verbose)
+        ok, ans, msg = recvlib.pop3_retr(s, args.rank, args.verbose, args.deadline)
         print(msg)
+        if ok and args.index:
+            try:
+                index = indexlib.index_open(args.index, args.verbose)
+            except (OSError, ValueError) as e:
+                error("index", str(e))
+            indexlib.index_add(index, recvlib.pop3_message(ans))
+            indexlib.index_close(index, args.verbose)
     if(args.cmd == 'dele'):
         ok, ans = recvlib.pop3_dele(s, args.rank, args.verbose)
     if not ok: error(args.cmd, ans)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Program: searchmail.py
+# Copyright: University of Bordeaux, France (2023).
+
+import sys
+import time
+import argparse
+import datetime
+import indexlib
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+INDEX_DIR = "index"
+LIMIT = 20
+
+###############################################
+###                ERROR                    ###
+###############################################
+
+def error(cmd, ans):
+    print(f"[Error {cmd}] {ans.strip()}")
+    sys.exit(1) # exit failure
+
+###############################################
+###                MAIN                     ###
+###############################################
+
+if __name__ == "__main__":
+
+    ## parse arguments
+    parser = argparse.ArgumentParser(prog='searchmail.py', description='search the mail downloaded by recvmail.py')
+    parser.add_argument('-i', '--index', type=str, default=INDEX_DIR, help='index directory')
+    parser.add_argument('-n', '--limit', type=int, default=LIMIT, help='max results (0 for all)')
+    parser.add_argument('-c', '--compact', action='store_true', default=False, help='merge the index segments first')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose')
+    parser.add_argument('query', type=str, nargs='*', help='query (e.g. from:toto subject:test after:2023-01-01)')
+    args = parser.parse_args()
+
+    ## print arguments
+    if args.verbose: print("args:", args.__dict__)
+
+    ## open index
+    try:
+        index = indexlib.index_open(args.index, args.verbose)
+    except (OSError, ValueError) as e:
+        error("index", str(e))
+
+    ## compact
+    if args.compact:
+        indexlib.index_compact(index, args.verbose)
+    if not args.query:
+        indexlib.index_close(index, args.verbose)
+        sys.exit(0)
+
+    ## search
+    start = time.perf_counter()
+    results = indexlib.index_search(index, ' '.join(args.query), args.limit or None)
+    elapsed = time.perf_counter() - start
+
+    for docid, ts, key, title in results:
+        date = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts >= 0 else '?'
+        print(f"{docid:>8} {date} {title} [{key}]")
+    if args.verbose: print(f"{len(results)} results in {elapsed * 1000:.1f} ms")
+
+    indexlib.index_close(index, args.verbose)
+
+### EOF
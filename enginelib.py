@@ -0,0 +1,400 @@
+#!/usr/bin/python3
+
+# Module: enginelib.py
+# Copyright: University of Bordeaux, France (2023).
+
+import os
+import ssl
+import time
+import errno
+import base64
+import socket
+import selectors
+import email.policy
+import sendlib
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+DOMAIN = "pouet.com"
+SESSION_DEADLINE = 120     # time allowed for a whole session (s)
+STEP_DEADLINE = 30         # time allowed for one command and its reply (s)
+MAXLINE = 65536
+
+###############################################
+###                 JOBS                    ###
+###############################################
+
+# The sessions are described as a list of steps run by a non-blocking
+# state machine, so the blocking commands of sendlib and recvlib cannot
+# be reused: the exchanges are written again here, and only the reply
+# parsing is shared (sendlib.smtp_complete).
+
+def step(cmd, expect, multiline=False, deadline=STEP_DEADLINE):
+    """
+    Describes one exchange of a session: a command and the expected reply.
+
+    Parameters:
+        - cmd (bytes): The command, None to only wait for a reply (greeting).
+        - expect (tuple): The accepted reply prefixes (None to accept any reply).
+        - multiline (bool): Indicates whether a successful POP3 reply ends with a "." line.
+        - deadline (float): The time allowed for the exchange, in seconds (None for no limit).
+
+    Returns:
+        - step (dict): The exchange.
+    """
+    return {'cmd': cmd, 'expect': expect, 'multiline': multiline, 'deadline': deadline}
+
+def _session(proto, host, port, secure, steps, deadline):
+    return {
+        'proto': proto,
+        'host': host,
+        'port': port,
+        'secure': secure,
+        'steps': steps,
+        'deadline': deadline,
+        'i': 0,                 # current step
+        'sock': None,
+        'state': 'new',
+        'out': b'',
+        'in': bytearray(),
+        'end': None,            # session deadline (time.monotonic() based)
+        'step_end': None,       # step deadline
+        'events': 0,
+        'callback': None,
+        'start': None,
+        'elapsed': None,
+        'replies': [],          # reply of each step
+        'ok': None,
+        'ans': "",
+    }
+
+###############################################
+
+def smtp_job(host, port, msg, secure=False, login=None, password=None,
+             deadline=SESSION_DEADLINE, data_deadline=STEP_DEADLINE):
+    """
+    Describes an SMTP session sending one message.
+
+    Parameters:
+        - host (str): The SMTP server: an IP address, or a name given to engine_resolve first.
+        - port (int): The port of the SMTP server.
+        - msg (email.message.EmailMessage): The message to send.
+        - secure (bool): Indicates whether the connection should be secure.
+        - login (str): The username for authentication (None for no authentication).
+        - password (str): The password for authentication.
+        - deadline (float): The time allowed for the whole session, in seconds.
+        - data_deadline (float): The time allowed to send the message and get the reply, in seconds.
+
+    Returns:
+        - session (dict): The session, to give to engine_add.
+    """
+    data = msg.as_bytes(policy=email.policy.SMTP)
+    data = data.replace(b'\r\n.', b'\r\n..')
+    if data.startswith(b'.'):
+        data = b'.' + data
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+
+    steps = [step(None, ('220',)), step(b'EHLO ' + DOMAIN.encode() + b'\r\n', ('250',))]
+    if login is not None:
+        auth = base64.b64encode(('\0' + login + '\0' + password).encode())
+        steps.append(step(b'AUTH PLAIN ' + auth + b'\r\n', ('235',)))
+    steps += [
+        step(b'MAIL FROM:<' + msg['From'].encode() + b'>\r\n', ('250',)),
+        step(b'RCPT TO:<' + msg['To'].encode() + b'>\r\n', ('25',)),
+        step(b'DATA\r\n', ('354',)),
+        step(data + b'.\r\n', ('250',), deadline=data_deadline),
+        step(b'QUIT\r\n', None),
+    ]
+    return _session('SMTP', host, port, secure, steps, deadline)
+
+def pop3_job(host, port, login, password, commands=('STAT',), secure=False,
+             deadline=SESSION_DEADLINE, command_deadline=STEP_DEADLINE):
+    """
+    Describes a POP3 session running some commands.
+
+    Parameters:
+        - host (str): The POP3 server: an IP address, or a name given to engine_resolve first.
+        - port (int): The port of the POP3 server.
+        - login (str): The username for authentication.
+        - password (str): The password for authentication.
+        - commands (list): The commands to run (e.g. 'STAT', 'LIST', 'RETR 1').
+        - secure (bool): Indicates whether the connection should be secure.
+        - deadline (float): The time allowed for the whole session, in seconds.
+        - command_deadline (float): The time allowed for each command (e.g. a whole RETR), in seconds.
+
+    Returns:
+        - session (dict): The session, to give to engine_add. The replies to
+          the commands are session['replies'][3:3 + len(commands)].
+    """
+    steps = [
+        step(None, ('+OK',)),
+        step(f"USER {login}\r\n".encode(), ('+OK',)),
+        step(f"PASS {password}\r\n".encode(), ('+OK',)),
+    ]
+    for cmd in commands:
+        name, *arg = cmd.upper().split()
+        multiline = name in ('RETR', 'TOP') or (name in ('LIST', 'UIDL') and not arg)
+        steps.append(step(f"{cmd}\r\n".encode(), ('+OK',), multiline, command_deadline))
+    steps.append(step(b'QUIT\r\n', None))
+    return _session('POP3', host, port, secure, steps, deadline)
+
+###############################################
+###                ENGINE                   ###
+###############################################
+
+def engine_new():
+    """
+    Creates an engine running many sessions in the calling thread.
+
+    Returns:
+        - eng (dict): The engine.
+    """
+    return {'sel': selectors.DefaultSelector(), 'active': [], 'done': [], 'addrs': {}}
+
+def engine_resolve(eng, host, port):
+    """
+    Looks up a server name, once, before its sessions are added.
+    This blocks (DNS), engine_add never does.
+
+    Parameters:
+        - eng (dict): The engine.
+        - host (str): The server name.
+        - port (int): The server port.
+
+    Returns:
+        - ok (bool): True if the name was found.
+    """
+    try:
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+    except socket.gaierror:
+        return False
+    eng['addrs'][(host, port)] = (family, address)
+    return True
+
+def _address(eng, host, port):
+    # a name given to engine_resolve, or an IPv4/IPv6 address (no lookup)
+    if (host, port) in eng['addrs']:
+        return eng['addrs'][(host, port)]
+    family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                                  flags=socket.AI_NUMERICHOST)[0]
+    return family, address
+
+def engine_add(eng, session, callback=None):
+    """
+    Starts a session (the connection is opened without blocking).
+
+    Parameters:
+        - eng (dict): The engine.
+        - session (dict): The session (see smtp_job and pop3_job).
+        - callback (function): Called with the session when it is over (None for no call).
+    """
+    now = time.monotonic()
+    session['callback'] = callback
+    session['start'] = now
+    session['end'] = now + session['deadline'] if session['deadline'] is not None else None
+    eng['active'].append(session)
+
+    try:
+        family, address = _address(eng, session['host'], session['port'])
+    except socket.gaierror:
+        _fail(eng, session, f"{session['host']}: not an address, call engine_resolve first")
+        return
+
+    try:
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setblocking(False)
+        session['sock'] = s
+        err = s.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(err, os.strerror(err))
+    except OSError as e:
+        _fail(eng, session, f"connection failed: {e}")
+        return
+    session['state'] = 'connecting'
+    _want(eng, session, selectors.EVENT_WRITE)
+
+###############################################
+
+def engine_step(eng, timeout=None):
+    """
+    Waits for the sessions to be ready (at most timeout) and advances them.
+
+    Parameters:
+        - eng (dict): The engine.
+        - timeout (float): The longest wait in seconds (None to wait for the next event or deadline).
+
+    Returns:
+        - n (int): The number of sessions still running.
+    """
+    if not eng['active']:
+        return 0
+
+    # wake up for the closest deadline
+    now = time.monotonic()
+    ends = [end for session in eng['active'] for end in (session['end'], session['step_end']) if end is not None]
+    wait = max(0.0, min(ends) - now) if ends else None
+    if timeout is not None:
+        wait = timeout if wait is None else min(wait, timeout)
+
+    for key, mask in eng['sel'].select(wait):
+        _advance(eng, key.data)
+
+    now = time.monotonic()
+    for session in list(eng['active']):
+        if any(end is not None and now >= end for end in (session['end'], session['step_end'])):
+            _fail(eng, session, "deadline exceeded")
+    return len(eng['active'])
+
+def engine_run(eng, timeout=None):
+    """
+    Runs the sessions until they are all over (or until timeout).
+
+    Parameters:
+        - eng (dict): The engine.
+        - timeout (float): The longest run in seconds (None to run until the end).
+
+    Returns:
+        - done (list): The sessions over, with their 'ok', 'ans', 'replies' and 'elapsed'.
+    """
+    end = time.monotonic() + timeout if timeout is not None else None
+    while eng['active']:
+        left = end - time.monotonic() if end is not None else None
+        if left is not None and left <= 0:
+            break
+        engine_step(eng, left)
+    return eng['done']
+
+###############################################
+
+def _want(eng, session, events):
+    # (re)register the socket for the events the session is waiting for
+    if session['events'] == events:
+        return
+    if session['events']:
+        eng['sel'].modify(session['sock'], events, session)
+    else:
+        eng['sel'].register(session['sock'], events, session)
+    session['events'] = events
+
+def _close(eng, session):
+    if session['events']:
+        eng['sel'].unregister(session['sock'])
+        session['events'] = 0
+    if session['sock'] is not None:
+        session['sock'].close()
+    session['state'] = 'done'
+    session['elapsed'] = time.monotonic() - session['start']
+    eng['active'].remove(session)
+    eng['done'].append(session)
+    if session['callback']:
+        session['callback'](session)
+
+def _fail(eng, session, ans):
+    session['ok'] = False
+    session['ans'] = ans
+    _close(eng, session)
+
+def _begin_step(eng, session):
+    if session['i'] == len(session['steps']):
+        session['ok'] = True
+        _close(eng, session)
+        return
+    st = session['steps'][session['i']]
+    session['step_end'] = time.monotonic() + st['deadline'] if st['deadline'] is not None else None
+    session['in'] = bytearray()
+    if st['cmd'] is not None:
+        session['out'] = memoryview(st['cmd'])
+        session['state'] = 'sending'
+        _want(eng, session, selectors.EVENT_WRITE)
+    else:
+        session['state'] = 'receiving'
+        _want(eng, session, selectors.EVENT_READ)
+
+def _complete(session):
+    # is the reply to the current step complete?
+    data = session['in']
+    if not data.endswith(b'\r\n'):
+        return False
+    if session['proto'] == 'SMTP':
+        return sendlib.smtp_complete(data)
+    if not session['steps'][session['i']]['multiline'] or not data.startswith(b'+OK'):
+        return True
+    return data.endswith(b'\r\n.\r\n')
+
+def _handshake(eng, session):
+    session['sock'].do_handshake()
+    _begin_step(eng, session)
+
+def _advance(eng, session):
+    s = session['sock']
+    try:
+        if session['state'] == 'connecting':
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                _fail(eng, session, f"connection failed: {os.strerror(err)}")
+                return
+            if session['secure']:
+                # same settings as sendlib: the certificate is not checked
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                eng['sel'].unregister(s)
+                session['events'] = 0
+                session['sock'] = context.wrap_socket(s, server_hostname=session['host'],
+                                                      do_handshake_on_connect=False)
+                session['state'] = 'handshake'
+                _want(eng, session, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                _handshake(eng, session)
+            else:
+                _begin_step(eng, session)
+
+        elif session['state'] == 'handshake':
+            _handshake(eng, session)
+
+        elif session['state'] == 'sending':
+            n = s.send(session['out'])
+            session['out'] = session['out'][n:]
+            if not session['out']:
+                session['state'] = 'receiving'
+                _want(eng, session, selectors.EVENT_READ)
+
+        elif session['state'] == 'receiving':
+            while True:
+                data = s.recv(MAXLINE)
+                if not data:
+                    if session['steps'][session['i']]['expect'] is None:
+                        # closed without a reply to QUIT: the work is done anyway
+                        session['ok'] = True
+                        _close(eng, session)
+                    else:
+                        _fail(eng, session, "connection closed")
+                    return
+                session['in'] += data
+                # data already decrypted is not seen by the selector
+                if not (session['secure'] and s.pending()):
+                    break
+            if _complete(session):
+                ans = session['in'].decode(errors='replace')
+                session['replies'].append(ans)
+                expect = session['steps'][session['i']]['expect']
+                if expect is not None:
+                    if not ans.startswith(expect):
+                        _fail(eng, session, ans)
+                        return
+                    session['ans'] = ans
+                session['i'] += 1
+                _begin_step(eng, session)
+
+    except ssl.SSLWantReadError:
+        _want(eng, session, selectors.EVENT_READ)
+    except ssl.SSLWantWriteError:
+        _want(eng, session, selectors.EVENT_WRITE)
+    except (BlockingIOError, InterruptedError):
+        pass
+    except OSError as e:
+        _fail(eng, session, str(e))
+
+### EOF
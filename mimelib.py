@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+# Module: mimelib.py
+# Copyright: University of Bordeaux, France (2023).
+
+import os
+import mmap
+import uuid
+import base64
+import binascii
+import mimetypes
+import email.header
+import email.utils
+import sendlib
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+B64_BLOCK = 57 * 1024      # raw bytes per base64 chunk (57 bytes = one 76 char line)
+QP_BLOCK = 64 * 1024       # raw bytes per quoted-printable chunk
+
+###############################################
+###               ENCODING                  ###
+###############################################
+
+def crlf(data):
+    # SMTP wants CRLF line endings, whatever the input uses (LF, CRLF or a lone CR),
+    # a bare CR is not allowed in DATA (RFC 5321 2.3.8)
+    return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n').replace(b'\n', b'\r\n')
+
+def encode_base64(data, block=B64_BLOCK):
+    """
+    Encodes a buffer in base64, one block at a time.
+
+    Parameters:
+        - data (bytes|mmap.mmap): The data to encode.
+        - block (int): The number of raw bytes per chunk (a multiple of 57).
+
+    Yields:
+        - chunk (bytes): Encoded lines, ending with CRLF.
+    """
+    for i in range(0, len(data), block):
+        yield base64.encodebytes(data[i:i + block]).replace(b'\n', b'\r\n')
+
+def encode_qp(data, block=QP_BLOCK):
+    """
+    Encodes a buffer in quoted-printable, one block of whole lines at a time.
+
+    Parameters:
+        - data (bytes|mmap.mmap): The data to encode.
+        - block (int): The approximate number of raw bytes per chunk.
+
+    Yields:
+        - chunk (bytes): Encoded lines, ending with CRLF.
+    """
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + block, size)
+        if end < size:
+            # cut after the last line end of the block, or mid-line if there is none
+            cut = max(data.rfind(b'\n', start, end), data.rfind(b'\r', start, end))
+            if cut >= start:
+                end = cut + 1
+                if data[cut:end] == b'\r' and data[end:end + 1] == b'\n':
+                    end += 1    # do not split a CRLF
+        # the line ends are made CRLF before encoding, so that no CR is left alone
+        chunk = crlf(binascii.b2a_qp(crlf(data[start:end]), istext=True))
+        if end < size and not chunk.endswith(b'\r\n'):
+            chunk += b'=\r\n'     # soft line break, the line goes on in the next chunk
+        yield chunk
+        start = end
+
+###############################################
+
+def encode_file(path, encoding):
+    """
+    Encodes a file without reading it in memory (the file is memory-mapped).
+
+    Parameters:
+        - path (str): The file to encode.
+        - encoding (str): 'base64' or 'quoted-printable'.
+
+    Yields:
+        - chunk (bytes): Encoded lines, ending with CRLF.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if encoding == 'base64':
+                yield from encode_base64(m)
+            else:
+                yield from encode_qp(m)
+
+###############################################
+###                 MIME                    ###
+###############################################
+
+def header(name, value):
+    # non-ASCII header values are encoded (RFC 2047), folded with CRLF like the rest
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        value = email.header.Header(value, 'utf-8', header_name=name).encode(linesep='\r\n')
+    return f"{name}: {value}\r\n".encode()
+
+def attachment_type(path):
+    """
+    Guesses the content type of a file and the encoding to use.
+
+    Parameters:
+        - path (str): The file.
+
+    Returns:
+        - ctype (str): The content type.
+        - encoding (str): 'quoted-printable' for text, 'base64' otherwise.
+    """
+    ctype, compressed = mimetypes.guess_type(path)
+    if ctype is None or compressed:
+        ctype = 'application/octet-stream'
+    return ctype, 'quoted-printable' if ctype.startswith('text/') else 'base64'
+
+###############################################
+
+def mime_stream(headers, body, paths):
+    """
+    Builds a multipart/mixed message, one chunk at a time.
+
+    Attachments are memory-mapped and encoded block by block, so the
+    encoded message is never held in memory.
+
+    Parameters:
+        - headers (list): The (name, value) headers (From, To, Subject, Date...).
+        - body (str): The text of the message.
+        - paths (list): The files to attach.
+
+    Yields:
+        - chunk (bytes): The message, with CRLF line endings.
+    """
+    boundary = f"=_{uuid.uuid4().hex}"
+
+    out = b''.join(header(name, value) for name, value in headers)
+    out += b'MIME-Version: 1.0\r\n'
+    out += f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n\r\n'.encode()
+
+    # text part
+    out += f'--{boundary}\r\n'.encode()
+    out += b'Content-Type: text/plain; charset="utf-8"\r\n'
+    out += b'Content-Transfer-Encoding: quoted-printable\r\n\r\n'
+    out += b''.join(encode_qp(body.encode()))
+    yield out
+
+    # attachments
+    for path in paths:
+        ctype, encoding = attachment_type(path)
+        filename = email.utils.encode_rfc2231(os.path.basename(path), 'utf-8')
+        part = f'\r\n--{boundary}\r\n'
+        part += f'Content-Type: {ctype}\r\n'
+        part += f'Content-Transfer-Encoding: {encoding}\r\n'
+        part += f'Content-Disposition: attachment; filename*={filename}\r\n\r\n'
+        yield part.encode()
+        yield from encode_file(path, encoding)
+
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+###############################################
+
+def mime_send(s, sender, recipient, headers, body, paths, verbose, deadline=None):
+    """
+    Sends a message with attachments to the SMTP server.
+
+    Parameters:
+        - s (socket): The socket connected to the SMTP server.
+        - sender (str): The envelope sender.
+        - recipient (str): The envelope recipient.
+        - headers (list): The (name, value) headers (From, To, Subject, Date...).
+        - body (str): The text of the message.
+        - paths (list): The files to attach.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - deadline (float): The time allowed for the whole transaction, in seconds (None for no limit).
+
+    Returns:
+        - ok (bool): Server status (True if the send is successful, False otherwise).
+        - ans (str): Server response.
+        - sent (bool): True once the server accepted DATA (see sendlib.smtp_send).
+    """
+    chunks = mime_stream(headers, body, paths)
+    return sendlib.smtp_send_stream(s, sender, recipient, chunks, verbose, deadline)
+
+### EOF
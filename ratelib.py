@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+# Module: ratelib.py
+# Copyright: University of Bordeaux, France (2023).
+
+import time
+import threading
+import collections
+import sendlib
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+## hard limits, per destination
+MAX_SESSIONS = 32          # messages in flight
+MAX_RATE = 100.0           # messages per second
+MIN_RATE = 0.2
+
+## policy
+INIT_RATE = 2.0
+RATE_STEP = 1.0            # additive increase of the rate, per second of sending
+BETA = 0.5                 # multiplicative decrease on congestion
+LATENCY_FACTOR = 2.0       # congestion when the latency exceeds the base latency this much...
+LATENCY_MARGIN = 0.05      # ...and by this many seconds at least (jitter of a fast server)
+LATENCY_EWMA = 0.2
+BASE_DRIFT = 0.001         # let the base latency grow slowly if the route changes
+COOLDOWN = 1.0             # at most one decrease per this long (s), or per latency if longer
+CONGESTION = (421, 451, 452)
+RETRIES = 3
+
+###############################################
+###              RATE CONTROL               ###
+###############################################
+
+def rate_controller(max_sessions=MAX_SESSIONS, max_rate=MAX_RATE, min_rate=MIN_RATE):
+    """
+    Creates a controller adjusting the concurrency and the rate of sending, per destination.
+
+    The window (messages in flight) and the rate (messages per second)
+    grow additively while the destination accepts the mail quickly, and
+    are halved on a congestion signal: a temporary failure (421, 451,
+    452), a lost connection, or a smoothed latency growing past
+    LATENCY_FACTOR times (and LATENCY_MARGIN above) the lowest one seen.
+
+    Parameters:
+        - max_sessions (int): The hard limit of messages in flight.
+        - max_rate (float): The hard limit of messages per second.
+        - min_rate (float): The lowest rate of messages per second.
+
+    Returns:
+        - ctl (dict): The controller (thread-safe).
+    """
+    return {
+        'cond': threading.Condition(),
+        'dests': {},
+        'max_sessions': max_sessions,
+        'max_rate': max_rate,
+        'min_rate': min_rate,
+    }
+
+def _dest(ctl, dest):
+    if dest not in ctl['dests']:
+        ctl['dests'][dest] = {
+            'window': 1.0,
+            'rate': min(INIT_RATE, ctl['max_rate']),
+            'inflight': 0,
+            'next': 0.0,            # earliest start of the next message
+            'latency': None,        # smoothed latency (s)
+            'base': None,           # lowest smoothed latency (s)
+            'decreased': 0.0,
+            'sent': 0,
+            'congested': 0,
+        }
+    return ctl['dests'][dest]
+
+###############################################
+
+def rate_acquire(ctl, dest, timeout=None):
+    """
+    Waits until a message may be sent to the destination.
+
+    Parameters:
+        - ctl (dict): The controller.
+        - dest (str): The destination (e.g. the relay host).
+        - timeout (float): The longest wait in seconds (None to wait forever).
+
+    Returns:
+        - ok (bool): True if the message may be sent (then call rate_release), False on timeout.
+    """
+    cond = ctl['cond']
+    end = None if timeout is None else time.monotonic() + timeout
+    with cond:
+        d = _dest(ctl, dest)
+        while True:
+            now = time.monotonic()
+            wait = None
+            if d['inflight'] >= int(d['window']):
+                wait = None if end is None else end - now
+            elif now < d['next']:
+                wait = d['next'] - now if end is None else min(d['next'], end) - now
+            else:
+                d['inflight'] += 1
+                d['next'] = max(now, d['next']) + 1.0 / d['rate']
+                return True
+            if end is not None and now >= end:
+                return False
+            cond.wait(wait)
+
+def rate_release(ctl, dest, code, latency):
+    """
+    Reports the outcome of a message and adjusts the window and the rate.
+
+    Parameters:
+        - ctl (dict): The controller.
+        - dest (str): The destination.
+        - code (int): The final reply code (None if the connection failed).
+        - latency (float): The time taken to send the message, in seconds.
+
+    Returns:
+        - spare (int): How many idle sessions the window leaves room for (close the others).
+    """
+    cond = ctl['cond']
+    with cond:
+        d = _dest(ctl, dest)
+        d['inflight'] -= 1
+        now = time.monotonic()
+
+        congested = code is None or code in CONGESTION
+        if code is not None and code < 400:
+            d['sent'] += 1
+            d['latency'] = latency if d['latency'] is None else \
+                d['latency'] + LATENCY_EWMA * (latency - d['latency'])
+            d['base'] = d['latency'] if d['base'] is None else min(d['latency'], d['base'] * (1 + BASE_DRIFT))
+            congested = d['latency'] > max(d['base'] * LATENCY_FACTOR, d['base'] + LATENCY_MARGIN)
+
+        if congested:
+            d['congested'] += 1
+            if now - d['decreased'] > max(COOLDOWN, d['latency'] or 0):
+                d['window'] = max(1.0, d['window'] * BETA)
+                d['rate'] = max(ctl['min_rate'], d['rate'] * BETA)
+                d['decreased'] = now
+        elif code is not None and code < 400:
+            d['window'] = min(ctl['max_sessions'], d['window'] + 1.0 / d['window'])
+            d['rate'] = min(ctl['max_rate'], d['rate'] + RATE_STEP / d['rate'])
+        # other failures (e.g. 550 unknown user) say nothing about the load
+
+        cond.notify_all()
+        return max(0, int(d['window']) - d['inflight'])
+
+###############################################
+
+def rate_metrics(ctl):
+    """
+    Returns the current state of the controller.
+
+    Parameters:
+        - ctl (dict): The controller.
+
+    Returns:
+        - metrics (dict): For each destination: window, rate, inflight, latency, base, sent, congested.
+    """
+    with ctl['cond']:
+        return {dest: {key: value for key, value in d.items() if key not in ('next', 'decreased')}
+                for dest, d in ctl['dests'].items()}
+
+###############################################
+
+def rate_send(ctl, dest, s, msg, verbose):
+    """
+    Sends a message once the controller allows it, and reports the outcome.
+
+    On failure, the session may be left in the middle of a transaction
+    (or closed by the server on 421): it should not be reused.
+
+    Parameters:
+        - ctl (dict): The controller.
+        - dest (str): The destination.
+        - s (socket): The socket connected to the SMTP server.
+        - msg (email.message.EmailMessage): The message to send.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+
+    Returns:
+        - ok (bool): Server status (True if the send is successful, False otherwise).
+        - ans (str): Server response.
+        - sent (bool): True once the server accepted DATA (see sendlib.smtp_send).
+    """
+    rate_acquire(ctl, dest)
+    start = time.monotonic()
+    ok, ans, sent = sendlib.smtp_send(s, msg, verbose)
+    rate_release(ctl, dest, sendlib.smtp_code(ans), time.monotonic() - start)
+    return ok, ans, sent
+
+###############################################
+
+def rate_send_many(ctl, host, port, secure, login, password, msgs, verbose, retries=RETRIES):
+    """
+    Sends messages to one relay as fast as it accepts them.
+
+    Up to max_sessions threads send, as many at once as the controller
+    allows. They share the sessions: one is opened when none is idle, and
+    the idle ones beyond the window are closed, so that a destination
+    that slowed down is not left with connections it cannot serve.
+    Temporary failures are retried (up to retries times) once the
+    controller slowed down, except a message left without a reply after
+    DATA was accepted, which may have been delivered.
+
+    Parameters:
+        - ctl (dict): The controller.
+        - host (str): The address of the SMTP server.
+        - port (int): The port of the SMTP server.
+        - secure (bool): Indicates whether the connection should be secure.
+        - login (str): The username for authentication (None for no authentication).
+        - password (str): The password for authentication.
+        - msgs (list): The messages to send (email.message.EmailMessage).
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - retries (int): How many times a temporary failure is retried.
+
+    Returns:
+        - results (list): The (ok, ans) of each message, in order.
+    """
+    results = [(False, "not sent")] * len(msgs)
+    queue = collections.deque((i, 0) for i in range(len(msgs)))
+    lock = threading.Lock()
+
+    def connect():
+        s = sendlib.smtp_connect(host, port, secure, verbose)
+        if not s:
+            return None, "connection failed"
+        ok, ans = sendlib.smtp_hello(s, verbose)
+        if ok and login is not None:
+            ok, ans = sendlib.smtp_auth(s, login, password, verbose)
+        if not ok:
+            s.close()
+            return None, ans
+        return s, ans
+
+    idle = []       # sessions open but not sending
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    break
+                i, attempt = queue.popleft()
+
+            rate_acquire(ctl, host)
+            with lock:
+                s = idle.pop() if idle else None
+            start = time.monotonic()
+            if s is None:
+                s, ans = connect()
+            if s is not None:
+                start = time.monotonic()    # the latency of the transaction only
+                ok, ans, sent = sendlib.smtp_send(s, msgs[i], verbose)
+            else:
+                ok, sent = False, False
+            code = sendlib.smtp_code(ans) if s is not None else None
+            spare = rate_release(ctl, host, code, time.monotonic() - start)
+
+            results[i] = (ok, ans)
+            if s is not None and not ok:
+                # the transaction may be left open (or the server gone): start over
+                s.close()
+                s = None
+            with lock:
+                if s is not None:
+                    idle.append(s)
+                extra = idle[spare:]
+                del idle[spare:]
+            for s in extra:
+                sendlib.smtp_quit(s, verbose)
+                s.close()
+            # without a reply once DATA was accepted, the message may have been delivered
+            if not ok and (code is None and not sent or code is not None and 400 <= code < 500) \
+                    and attempt < retries:
+                with lock:
+                    queue.append((i, attempt + 1))
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(min(ctl['max_sessions'], len(msgs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for s in idle:
+        sendlib.smtp_quit(s, verbose)
+        s.close()
+    return results
+
+### EOF
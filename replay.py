@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# Program: replay.py
+# Copyright: University of Bordeaux, France (2023).
+
+import sys
+import time
+import socket
+import argparse
+import threading
+import tracelib
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+REPLAY_HOST = "localhost"
+REPLAY_PORT = 10025
+SCALE = 1.0
+
+###############################################
+###                ERROR                    ###
+###############################################
+
+def error(cmd, ans):
+    print(f"[Error {cmd}] {ans.strip()}")
+    sys.exit(1) # exit failure
+
+###############################################
+###                REPLAY                   ###
+###############################################
+
+def summary(session, events):
+    """
+    Prints a session: time, direction, size and first line of each exchange.
+
+    Parameters:
+        - session (int): The session id.
+        - events (list): The (kind, time, data) of the session.
+    """
+    print(f"[Session {session}]")
+    sent = recv = 0
+    last = 0.0
+    for kind, t, data in events:
+        size = len(data)
+        if kind == tracelib.PAYLOAD:
+            size, lines, end = tracelib.PAYLOAD_INFO.unpack(data)
+            line = f"<{lines} lines{', end of message' if end else ''}>"
+        elif kind == tracelib.START:
+            wall, = tracelib.START_INFO.unpack(data)
+            line = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(wall))
+        else:
+            line = data.splitlines()[0][:60].decode(errors='replace') if data else ''
+        if kind in (tracelib.SEND, tracelib.PAYLOAD):
+            sent += size
+        elif kind == tracelib.RECV:
+            recv += size
+        print(f"{t * 1000:10.1f} ms  +{(t - last) * 1000:8.1f}  {tracelib.KINDS[kind]:7} {size:8}  {line}")
+        last = t
+    print(f"{len(events)} events, {sent} bytes sent, {recv} bytes received")
+
+def schedule(sessions):
+    """
+    Orders the sessions as they were recorded, and finds those that overlap
+    (several threads, the daemon pool): they are replayed at the same time,
+    each one at its recorded offset from the first of them. The others are
+    replayed when their client connects.
+
+    Parameters:
+        - sessions (dict): For each session id, the list of (kind, time, data).
+
+    Returns:
+        - plan (list): The (session, offset) in start order, the offset in seconds
+          from the first session of the group (None for the first one).
+    """
+    starts = {}
+    for session, events in sessions.items():
+        # transcripts of version 1 have no start time: one session after the other
+        starts[session] = next((tracelib.START_INFO.unpack(data)[0]
+                                for kind, t, data in events if kind == tracelib.START), None)
+    order = sorted(sessions, key=lambda session: (starts[session] or 0.0, session))
+
+    plan = []
+    first = end = None
+    for session in order:
+        start = starts[session]
+        if start is None or end is None or start > end:
+            first, end = start, start
+            plan.append((session, None))
+        else:
+            plan.append((session, start - first))
+        if start is not None:
+            end = max(end, start + sessions[session][-1][1])
+    return plan
+
+###############################################
+
+def replay(c, events, scale, verbose, start=None):
+    """
+    Plays the server side of a recorded session on a client connection.
+
+    The replies are sent with the recorded delays (times scale), counted
+    from the moment the client sent what it had sent before them. The
+    client commands are read line by line: the content may differ from
+    the recording, as long as the number of lines is the same. A message
+    sent after DATA is read up to its final "." line, whatever its size.
+
+    Parameters:
+        - c (socket): The client connection.
+        - events (list): The (kind, time, data) of the session.
+        - scale (float): The factor applied to the recorded delays.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - start (float): When the session started (time.monotonic() based), None for now.
+    """
+    ref_wall = time.monotonic() if start is None else start
+    ref_t = 0.0
+    pending = b''
+    size = 0
+
+    for kind, t, data in events:
+        if kind == tracelib.RECV:
+            delay = ref_wall + (t - ref_t) * scale - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if data:
+                c.sendall(data)
+            ref_wall, ref_t = time.monotonic(), t
+        elif kind == tracelib.SEND:
+            # wait for as many lines as the client had sent
+            lines = data.count(b'\n')
+            while pending.count(b'\n') < lines:
+                chunk = c.recv(65536)
+                if not chunk:
+                    return
+                pending += chunk
+            for _ in range(lines):
+                line, _, pending = pending.partition(b'\n')
+                if verbose:
+                    print(f"C: {line[:60].decode(errors='replace').strip()}")
+            ref_wall, ref_t = time.monotonic(), t
+        elif kind == tracelib.PAYLOAD:
+            n, lines, end = tracelib.PAYLOAD_INFO.unpack(data)
+            size += n
+            if not end:
+                continue
+            # skip the message (it may be large), keeping what follows its "." line
+            buf = b'\r\n' + pending
+            while True:
+                i = buf.find(b'\r\n.\r\n')
+                if i >= 0:
+                    pending = buf[i + 5:]
+                    break
+                buf = buf[-4:]
+                chunk = c.recv(65536)
+                if not chunk:
+                    return
+                buf += chunk
+            if verbose:
+                print(f"C: <message, {size} bytes when recorded>")
+            size = 0
+            ref_wall, ref_t = time.monotonic(), t
+        elif kind in (tracelib.CLOSE, tracelib.ERROR):
+            break
+
+def serve(c, address, session, events, start, scale, verbose):
+    # one session on its own connection (and thread)
+    accepted = time.monotonic()
+    with c:
+        try:
+            replay(c, events, scale, verbose, start)
+        except OSError as e:
+            print(f"[Session {session}] {e}")
+    print(f"[Session {session}] {address[0]}:{address[1]} {(time.monotonic() - accepted) * 1000:.1f} ms", flush=True)
+
+###############################################
+###                MAIN                     ###
+###############################################
+
+if __name__ == "__main__":
+
+    ## parse arguments
+    parser = argparse.ArgumentParser(prog='replay.py', description='replays recorded SMTP/POP3 sessions as a fake server')
+    parser.add_argument('-H', '--host', type=str, default=REPLAY_HOST, help='listen host')
+    parser.add_argument('-P', '--port', type=int, default=REPLAY_PORT, help='listen port')
+    parser.add_argument('-x', '--scale', type=float, default=SCALE, help='delay scale (0 for no delay)')
+    parser.add_argument('-L', '--loop', action='store_true', default=False, help='start over after the last session')
+    parser.add_argument('-l', '--list', action='store_true', default=False, help='print the sessions and exit')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose')
+    parser.add_argument('trace', type=str, help='transcript file (recorded with --trace)')
+    args = parser.parse_args()
+
+    ## print arguments
+    if args.verbose: print("args:", args.__dict__)
+
+    ## read transcript
+    try:
+        proto, sessions = tracelib.trace_read(args.trace)
+    except (OSError, ValueError) as e:
+        error("trace", str(e))
+    if not sessions: error("trace", "no session")
+
+    if args.list:
+        print(f"Protocol: {proto}")
+        for session, events in sorted(sessions.items()):
+            summary(session, events)
+        sys.exit(0)
+
+    ## serve the sessions in the recorded order, one per connection,
+    ## at the same time when they overlapped
+    plan = schedule(sessions)
+    l = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    l.bind((args.host, args.port))
+    l.listen()
+    print(f"Replaying {len(sessions)} {proto} sessions on {args.host}:{args.port}", flush=True)
+
+    threads = []
+    try:
+        while True:
+            for session, offset in plan:
+                c, address = l.accept()
+                now = time.monotonic()
+                if offset is None:
+                    first = now
+                # a client connecting before the recorded offset waits for its session to start
+                start = max(now, first + offset * args.scale) if offset is not None else now
+                t = threading.Thread(target=serve, daemon=True,
+                                     args=(c, address, session, sessions[session], start, args.scale, args.verbose))
+                t.start()
+                threads = [thread for thread in threads if thread.is_alive()] + [t]
+            if not args.loop:
+                break
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        pass
+    l.close()
+    print("[Success]")
+
+### EOF
@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+
+# Module: senddaemon.py
+# Copyright: University of Bordeaux, France (2023).
+
+import os
+import io
+import sys
+import time
+import signal
+import socket
+import threading
+import sendlib
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+NOOP_AFTER = 5        # check a session idle for more than this with NOOP (s)
+SESSION_IDLE = 300    # close a session idle for more than this (s)
+BACKLOG = 64
+MAXREQUEST = 1 << 20
+REQUEST_TIMEOUT = 10  # time allowed to a client to send its request or read a reply chunk (s)
+KEEPALIVE = 5         # a byte is sent to the client this often while its mail is sent (s)
+WORKERS = 16          # requests served at the same time
+POOL_SIZE = 4         # idle sessions kept per server
+
+###############################################
+###               SESSION POOL              ###
+###############################################
+
+def pool_key(args):
+    return (args.host, args.port, args.secure, args.auth, args.login, args.password, args.trace)
+
+def pool_new():
+    """
+    Creates an empty pool of warm sessions, shared by the request threads.
+
+    Returns:
+        - pool (dict): The warm sessions.
+    """
+    return {'lock': threading.Lock(), 'idle': {}}
+
+def pool_get(pool, args, open_session):
+    """
+    Gets an authenticated session for the server described by args.
+    The session is taken out of the pool until pool_put or pool_drop.
+
+    Parameters:
+        - pool (dict): The warm sessions.
+        - args (argparse.Namespace): The command line arguments.
+        - open_session (function): Opens a new session from args.
+
+    Returns:
+        - s (socket): The socket ready to send mail.
+        - warm (bool): True if the session was reused.
+    """
+    with pool['lock']:
+        idle = pool['idle'].get(pool_key(args))
+        entry = idle.pop() if idle else None
+    if entry:
+        s, last = entry
+        if time.monotonic() - last < NOOP_AFTER:
+            return s, True
+        ok, ans = sendlib.smtp_noop(s, args.verbose)
+        if ok:
+            return s, True
+        s.close()
+    return open_session(args), False
+
+def pool_put(pool, args, s):
+    """
+    Gives a session back to the pool once the mail is sent.
+
+    Parameters:
+        - pool (dict): The warm sessions.
+        - args (argparse.Namespace): The command line arguments.
+        - s (socket): The socket to keep.
+    """
+    with pool['lock']:
+        idle = pool['idle'].setdefault(pool_key(args), [])
+        idle.append((s, time.monotonic()))
+        extra = idle[:-POOL_SIZE]
+        del idle[:-POOL_SIZE]
+    for s, _ in extra:
+        sendlib.smtp_quit(s, args.verbose)
+        s.close()
+
+def pool_drop(pool, s):
+    """
+    Closes a session taken with pool_get that cannot be used any more.
+
+    Parameters:
+        - pool (dict): The warm sessions.
+        - s (socket): The socket to close.
+    """
+    s.close()
+
+def pool_expire(pool, verbose, idle=SESSION_IDLE):
+    """
+    Closes the sessions idle for more than SESSION_IDLE seconds.
+
+    Parameters:
+        - pool (dict): The warm sessions.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - idle (float): The longest idle time kept, in seconds (0 to close all).
+    """
+    now = time.monotonic()
+    expired = []
+    with pool['lock']:
+        for key, sessions in list(pool['idle'].items()):
+            expired += [s for s, last in sessions if now - last >= idle]
+            sessions[:] = [(s, last) for s, last in sessions if now - last < idle]
+            if not sessions:
+                del pool['idle'][key]
+    for s in expired:
+        sendlib.smtp_quit(s, verbose)
+        s.close()
+
+###############################################
+###                DAEMON                   ###
+###############################################
+
+def daemon_listen(path, verbose):
+    """
+    Creates the UNIX socket of the daemon (only accessible to the user).
+
+    The socket directory is created if needed and must belong to the user
+    and be closed to the others, so that nobody can replace the socket.
+
+    Parameters:
+        - path (str): The UNIX socket path.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+
+    Returns:
+        - l (socket): The listening socket (None if a daemon is already running
+          or the directory is not private).
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        print(f"[Error daemon] {directory} is not private (owner {st.st_uid}, mode {st.st_mode & 0o777:o})")
+        return None
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            probe.close()
+            if verbose:
+                print(f"Daemon already running on {path}")
+            return None
+        except OSError:
+            probe.close()
+            os.unlink(path)    # stale socket
+
+    l = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        l.bind(path)
+    finally:
+        os.umask(umask)
+    l.listen(BACKLOG)
+    if verbose:
+        print(f"Listening on {path}")
+    return l
+
+###############################################
+
+class _Output:
+    """
+    The standard output of the daemon: what a request thread prints goes
+    to the reply of its client, the rest to the daemon output.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return (getattr(self.local, 'out', None) or self.stream).write(text)
+
+    def flush(self):
+        (getattr(self.local, 'out', None) or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def _private(argv):
+    # the arguments as they may be logged: without the password
+    shown = []
+    hide = False
+    for arg in argv:
+        if hide:
+            arg, hide = '***', False
+        elif arg.startswith('--'):
+            # argparse accepts any unambiguous prefix (--pass, --password=...)
+            name, eq, _ = arg.partition('=')
+            if len(name) > 3 and '--password'.startswith(name):
+                if eq:
+                    arg = name + '=***'
+                else:
+                    hide = True
+        elif arg.startswith('-') and 'p' in arg:
+            # -p, -pSECRET or flags grouped before it (-vp)
+            i = arg.index('p')
+            if i == len(arg) - 1:
+                hide = True
+            else:
+                arg = arg[:i + 1] + '***'
+        shown.append(arg)
+    return shown
+
+def daemon_handle(c, pool, verbose):
+    """
+    Runs one request: sends the mail with sendmail.main and returns its output.
+
+    Parameters:
+        - c (socket): The client connection (with a timeout).
+        - pool (dict): The warm sessions.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+    """
+    import sendmail
+
+    # only the user may send mail through the daemon (elsewhere, the socket mode is the only check)
+    if hasattr(socket, 'SO_PEERCRED'):
+        uid = sendmail.peer_uid(c, None)
+        if uid != os.getuid():
+            if verbose:
+                print(f"Request from user {uid} refused")
+            return
+
+    # a client that does not finish its request in time is dropped, nothing is sent
+    data = bytearray()
+    while len(data) < MAXREQUEST:
+        chunk = c.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    cwd, *argv = data.decode(errors='surrogateescape').split('\0')
+
+    # the client waits as long as the daemon shows it is alive (a large attachment takes time)
+    done = threading.Event()
+    def keepalive():
+        try:
+            while not done.wait(KEEPALIVE):
+                c.sendall(b'\0')
+        except OSError:
+            pass    # the client is gone, the mail is sent anyway
+    alive = threading.Thread(target=keepalive, daemon=True)
+    alive.start()
+
+    out = io.StringIO()
+    code = 0
+    sys.stdout.local.out = out
+    try:
+        sendmail.main(argv, pool, cwd)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        print(f"[Error daemon] {e}")
+        code = 1
+    finally:
+        sys.stdout.local.out = None
+        done.set()
+        alive.join()
+    if verbose:
+        print(f"Request {_private(argv)}: exit {code}")
+    c.sendall(f"{code & 0xff}\n".encode() + out.getvalue().encode())
+
+def daemon_worker(c, pool, verbose, workers):
+    # one request per thread, so a slow client or a large attachment does not hold the others
+    with c:
+        c.settimeout(REQUEST_TIMEOUT)
+        try:
+            daemon_handle(c, pool, verbose)
+        except OSError as e:
+            if verbose:
+                print(f"Request failed: {e}")
+        finally:
+            workers.release()
+
+###############################################
+
+def daemon_serve(path, verbose):
+    """
+    Serves the sendmail.py clients on the UNIX socket until interrupted,
+    keeping the SMTP sessions open between the mails. Each request is
+    served by its own thread (at most WORKERS at a time).
+
+    Parameters:
+        - path (str): The UNIX socket path.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+    """
+    l = daemon_listen(path, verbose)
+    if not l:
+        return
+    l.settimeout(NOOP_AFTER)
+    pool = pool_new()
+    workers = threading.BoundedSemaphore(WORKERS)
+
+    # what the requests print goes to their client
+    sys.stdout = sys.stderr = _Output(sys.stdout)
+
+    # stop cleanly on kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        while True:
+            try:
+                c, _ = l.accept()
+            except socket.timeout:
+                pool_expire(pool, verbose)
+                continue
+            workers.acquire()
+            threading.Thread(target=daemon_worker, args=(c, pool, verbose, workers), daemon=True).start()
+            pool_expire(pool, verbose)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        l.close()
+        os.unlink(path)
+        pool_expire(pool, verbose, 0)
+
+### EOF
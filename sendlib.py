@@ -7,6 +7,7 @@ import sys
 import socket
 import base64
 import ssl
+import time
 import email
 
 ###############################################
@@ -21,7 +22,80 @@ MAXLINE= 1024
 ###               SMTP/CLIENT               ###
 ###############################################
 
-def smtp_connect(host, port, secure, verbose):
+def smtp_deadline(s, end):
+    """
+    Sets the socket timeout to the time left before a deadline.
+
+    Parameters:
+        - s (socket): The socket connected to the SMTP server.
+        - end (float): The deadline (time.monotonic() based), None to keep the timeout.
+
+    Raises:
+        - socket.timeout: If the deadline has passed.
+    """
+    if end is None:
+        return
+    left = end - time.monotonic()
+    if left <= 0:
+        raise socket.timeout("deadline exceeded")
+    s.settimeout(left)
+
+def smtp_reply(s, end=None):
+    """
+    Receives a complete (possibly multiline) reply from the SMTP server.
+
+    Parameters:
+        - s (socket): The socket connected to the SMTP server.
+        - end (float): The deadline for the whole reply (None: TIMEOUT for each recv).
+
+    Returns:
+        - ans (str): Server response.
+    """
+    data = bytearray()
+    while True:
+        smtp_deadline(s, end)
+        chunk = s.recv(MAXLINE)
+        if not chunk:
+            break
+        data += chunk
+        if smtp_complete(data):
+            break
+    return data.decode()
+
+def smtp_complete(data):
+    """
+    Tells whether a reply of the SMTP server is complete.
+
+    Parameters:
+        - data (bytes): The reply received so far.
+
+    Returns:
+        - complete (bool): True if the last line received ends the reply.
+    """
+    if not data.endswith(b'\r\n'):
+        return False
+    # the last line of a reply is "ddd text" (or "ddd"), the others are "ddd-text"
+    start = data.rfind(b'\r\n', 0, len(data) - 2)
+    last = data[start + 2 if start >= 0 else 0:]
+    return last[3:4] in (b' ', b'\r')
+
+def smtp_code(ans):
+    """
+    Extracts the reply code from a response of the SMTP server.
+
+    Parameters:
+        - ans (str): Server response.
+
+    Returns:
+        - code (int): The reply code (None if the response is not a reply, e.g. a socket error).
+    """
+    if len(ans) >= 3 and ans[:3].isdigit():
+        return int(ans[:3])
+    return None
+
+###############################################
+
+def smtp_connect(host, port, secure, verbose, trace=None):
     """
     Connects the socket to the specified SMTP server.
 
@@ -30,6 +104,7 @@ def smtp_connect(host, port, secure, verbose):
         - port (int): The port of the SMTP server.
         - secure (bool): Indicates whether the connection should be secure.
         - verbose (bool): Indicates whether debug messages should be displayed.
+        - trace (str): A file to record the session in (see tracelib), None to not record.
 
     Returns:
         - s (socket): The socket connected to the SMTP server.
@@ -45,7 +120,13 @@ def smtp_connect(host, port, secure, verbose):
             context.verify_mode = ssl.CERT_NONE
 
             s = context.wrap_socket(s, server_hostname=host)
+        if trace:
+            import tracelib
+            s = tracelib.trace_socket(s, trace, 'SMTP')
         s.connect((host, port))
+        greeting = smtp_reply(s)
+        if not greeting.startswith('220'):
+            raise ConnectionError(greeting.strip() or "no greeting")
         if verbose:
             print(f"Connected to {host} on port {port}")
         return s
@@ -71,7 +152,7 @@ def smtp_hello(s, verbose):
     """
     try:
         s.sendall(b'EHLO ' + DOMAIN.encode() +  b'\r\n')
-        response = s.recv(MAXLINE).decode()
+        response = smtp_reply(s)
         if verbose:
             print(f"EHLO response: {response}")
         return '250' in response, response
@@ -137,7 +218,7 @@ def smtp_noop(s, verbose):
 
 ###############################################
 
-def smtp_send(s, msg, verbose):
+def smtp_send(s, msg, verbose, deadline=None):
     """
     Sends the specified message to the SMTP server.
 
@@ -145,33 +226,125 @@ def smtp_send(s, msg, verbose):
         - s (socket): The socket connected to the SMTP server.
         - msg (email.message.EmailMessage): The message to send.
         - verbose (bool): Indicates whether debug messages should be displayed.
+        - deadline (float): The time allowed for the whole transaction, in seconds
+          (None: TIMEOUT for each recv, however long the transaction).
 
     Returns:
         - ok (bool): Server status (True if the send is successful, False otherwise).
         - ans (str): Server response.
+        - sent (bool): True once the server accepted DATA: on failure, the message may
+          still have been delivered (e.g. the final reply was lost) and must not be sent again.
     """
+    end = time.monotonic() + deadline if deadline is not None else None
+    sent = False
     try:
-        # responses = []
+        # read every reply, so that the session stays usable for the next message
+        smtp_deadline(s, end)
         s.sendall(b'MAIL FROM:<' + msg['From'].encode() + b'>\r\n')
-        # responses += s.recv(MAXLINE).decode()
+        response = smtp_reply(s, end)
+        if not response.startswith('250'):
+            return False, response, sent
 
+        smtp_deadline(s, end)
         s.sendall(b'RCPT TO:<' + msg['To'].encode() + b'>\r\n')
-        # responses += s.recv(MAXLINE).decode()
+        response = smtp_reply(s, end)
+        if not response.startswith('25'):
+            return False, response, sent
 
+        smtp_deadline(s, end)
         s.sendall(b'DATA\r\n')
-        # responses += s.recv(MAXLINE).decode()
+        response = smtp_reply(s, end)
+        if not response.startswith('354'):
+            return False, response, sent
+        sent = True
 
         data_body = msg['Subject'].encode() + b'\n' + msg['Date'].encode() + b'\n' + msg.get_payload().encode()
+        smtp_deadline(s, end)
         s.sendall(data_body + b'\r\n.\r\n')
-        response = s.recv(MAXLINE).decode()
+        response = smtp_reply(s, end)
 
         if verbose:
             print(f"SEND response: {response}")
-        return '250' in response, response
+        return '250' in response, response, sent
     except Exception as e:
         if verbose:
             print(f"SEND failed: {e}")
-        return False, str(e)
+        return False, str(e), sent
+    finally:
+        if end is not None:
+            s.settimeout(TIMEOUT)
+
+###############################################
+
+def smtp_send_stream(s, sender, recipient, chunks, verbose, deadline=None):
+    """
+    Sends a message produced chunk by chunk to the SMTP server.
+
+    Each chunk is sent as soon as it is produced, with dot-stuffing
+    (RFC 5321, 4.5.2), so the message is never held in memory.
+
+    Parameters:
+        - s (socket): The socket connected to the SMTP server.
+        - sender (str): The envelope sender.
+        - recipient (str): The envelope recipient.
+        - chunks (iterable): The message (headers and body) as bytes, with CRLF line endings.
+        - verbose (bool): Indicates whether debug messages should be displayed.
+        - deadline (float): The time allowed for the whole transaction, in seconds
+          (None: TIMEOUT for each recv, however long the transaction).
+
+    Returns:
+        - ok (bool): Server status (True if the send is successful, False otherwise).
+        - ans (str): Server response.
+        - sent (bool): True once the server accepted DATA (see smtp_send).
+    """
+    end = time.monotonic() + deadline if deadline is not None else None
+    sent = False
+    try:
+        smtp_deadline(s, end)
+        s.sendall(b'MAIL FROM:<' + sender.encode() + b'>\r\n')
+        response = smtp_reply(s, end)
+        if not response.startswith('250'):
+            return False, response, sent
+
+        smtp_deadline(s, end)
+        s.sendall(b'RCPT TO:<' + recipient.encode() + b'>\r\n')
+        response = smtp_reply(s, end)
+        if not response.startswith('25'):
+            return False, response, sent
+
+        smtp_deadline(s, end)
+        s.sendall(b'DATA\r\n')
+        response = smtp_reply(s, end)
+        if not response.startswith('354'):
+            return False, response, sent
+        sent = True
+
+        newline = True    # at the beginning of a line
+        size = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            chunk = chunk.replace(b'\n.', b'\n..')
+            if newline and chunk[:1] == b'.':
+                chunk = b'.' + chunk
+            newline = chunk.endswith(b'\n')
+            smtp_deadline(s, end)
+            s.sendall(chunk)
+            size += len(chunk)
+        smtp_deadline(s, end)
+        s.sendall(b'.\r\n' if newline else b'\r\n.\r\n')
+        response = smtp_reply(s, end)
+
+        if verbose:
+            print(f"SEND response ({size} bytes): {response}")
+        return '250' in response, response, sent
+    except Exception as e:
+        if verbose:
+            print(f"SEND failed: {e}")
+        return False, str(e), sent
+    finally:
+        if end is not None:
+            s.settimeout(TIMEOUT)
 
 ###############################################
 
@@ -3,11 +3,11 @@
 # Program: sendmail.py
 # Copyright: University of Bordeaux, France (2023).
 
+# Only the modules needed to hand the message to the daemon are imported
+# here, the others are imported when the message is sent directly.
 import sys
-import argparse
-import sendlib as sendlib
-import email.utils
-import email.message
+import os
+import socket
 
 ###############################################
 ###                DEFAULT                  ###
@@ -27,6 +27,12 @@ RECIPIENT = "tutu@pouet.com"
 SUBJECT = "Test"
 BODY = "Hello World!"
 
+## daemon config: the socket lives in a directory only the user can use
+DAEMON_DIR = os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/sendmail-{os.getuid()}"
+DAEMON_SOCKET = os.environ.get("SENDMAIL_SOCKET", os.path.join(DAEMON_DIR, "sendmail.sock"))
+HANDOFF_TIMEOUT = 5     # time allowed to connect and hand the request over (s)
+REPLY_TIMEOUT = 30      # longest silence of the daemon while it sends (it shows it is alive every few seconds)
+
 ###############################################
 ###                ERROR                    ###
 ###############################################
@@ -35,13 +41,89 @@ def error(cmd, ans):
     print(f"[Error {cmd}] {ans.strip()}")
     sys.exit(1) # exit failure
 
+###############################################
+###                CLIENT                   ###
+###############################################
+
+def peer_uid(c, path):
+    """
+    Finds the user at the other end of a UNIX socket connection.
+
+    Parameters:
+        - c (socket): The connection.
+        - path (str): The UNIX socket path.
+
+    Returns:
+        - uid (int): The user id of the peer (the owner of the socket file
+          where SO_PEERCRED is not available).
+    """
+    if hasattr(socket, 'SO_PEERCRED'):
+        import struct
+        creds = struct.Struct('3i')     # pid, uid, gid
+        return creds.unpack(c.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size))[1]
+    return os.stat(path).st_uid
+
+def handoff(argv, path):
+    """
+    Hands the command line over to the sendmail daemon.
+
+    Parameters:
+        - argv (list): The command line arguments.
+        - path (str): The UNIX socket of the daemon.
+
+    Returns:
+        - code (int): The exit status of the command (None if the daemon is not running).
+    """
+    try:
+        c = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        c.settimeout(HANDOFF_TIMEOUT)
+        c.connect(path)
+        uid = peer_uid(c, path)
+    except OSError:
+        return None
+
+    # the arguments may hold a password: only hand them to our own daemon
+    if uid != os.getuid():
+        c.close()
+        print(f"[Warning daemon] {path} belongs to user {uid}, sending directly")
+        return None
+
+    # request: cwd and arguments separated by NUL,
+    # reply: NUL bytes while the mail is sent, then the exit status on a line and the output
+    with c:
+        try:
+            c.sendall('\0'.join([os.getcwd()] + argv).encode(errors='surrogateescape'))
+            c.shutdown(socket.SHUT_WR)
+        except OSError:
+            # the daemon only runs complete requests: nothing was sent
+            return None
+        data = bytearray()
+        try:
+            c.settimeout(REPLY_TIMEOUT)
+            while True:
+                chunk = c.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError:
+            data = bytearray()
+
+    status, _, output = data.lstrip(b'\0').partition(b'\n')
+    if not status.isdigit():
+        # the daemon may have sent the message before failing: do not resend it
+        print("[Error daemon] no reply")
+        return 1
+    sys.stdout.write(output.decode(errors='replace'))
+    sys.stdout.flush()
+    return int(status)
+
 ###############################################
 ###                MAIN                     ###
 ###############################################
 
-if __name__ == "__main__":
+def parse_args(argv):
+    import argparse
 
-    ## parse arguments
     parser = argparse.ArgumentParser(prog='sendmail.py', description='SMTP client')
     parser.add_argument('-H', '--host', type=str, default=SMTP_HOST, help='server host')
     parser.add_argument('-P', '--port', type=int, default=0, help='server port')
@@ -53,17 +135,36 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--to', type=str, dest="recipient", default=RECIPIENT, help='mail recipient')
     parser.add_argument('-s', '--subject', type=str, default=SUBJECT, help='mail subject')
     parser.add_argument('-b', '--body', type=str, default=BODY, help='mail body')
+    parser.add_argument('-a', '--attach', type=str, action='append', default=[], help='attach a file (repeatable)')
+    parser.add_argument('-d', '--deadline', type=float, default=None, help='time allowed to send the mail (s)')
+    parser.add_argument('--trace', type=str, default=None, help='record the session in this file (see replay.py)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='verbose')
-    args = parser.parse_args()
+    parser.add_argument('--daemon', action='store_true', default=False, help=f'run the daemon on {DAEMON_SOCKET} (SENDMAIL_SOCKET)')
+    parser.add_argument('--no-daemon', action='store_true', default=False, help='always send directly')
+    args = parser.parse_args(argv)
 
     ## set default port
     if args.port == 0: args.port = SMTP_PORT_SECURE if args.secure else SMTP_PORT
 
-    ## print arguments
-    if args.verbose: print("args:", args.__dict__)
+    return args
+
+###############################################
+
+def open_session(args):
+    """
+    Connects, says hello and authenticates (if requested) to the SMTP server.
+    Exits on failure.
+
+    Parameters:
+        - args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        - s (socket): The socket ready to send mail.
+    """
+    import sendlib
 
     ## start smtp client
-    s = sendlib.smtp_connect(args.host, args.port, args.secure, args.verbose)
+    s = sendlib.smtp_connect(args.host, args.port, args.secure, args.verbose, args.trace)
     if not s: error("connect", "")
 
     ## hello
@@ -75,6 +176,33 @@ if __name__ == "__main__":
         ok, ans = sendlib.smtp_auth(s, args.login, args.password, args.verbose)
         if not ok: error("auth", ans)
 
+    return s
+
+###############################################
+
+def main(argv, pool=None, cwd=None):
+    """
+    Sends one mail as described by the command line. Exits on failure.
+
+    Parameters:
+        - argv (list): The command line arguments.
+        - pool (dict): Warm sessions kept by the daemon (None to connect and quit).
+        - cwd (str): The directory of the client, for relative paths (None for the current one).
+    """
+    import sendlib
+    import email.utils
+    import email.message
+
+    args = parse_args(argv)
+
+    ## the daemon serves clients from many directories at once
+    if cwd:
+        args.attach = [os.path.join(cwd, path) for path in args.attach]
+        if args.trace: args.trace = os.path.join(cwd, args.trace)
+
+    ## print arguments
+    if args.verbose: print("args:", args.__dict__)
+
     ## prepare mail
     date = email.utils.formatdate(localtime=True)  # current date (RFC 5322)
     msg = email.message.EmailMessage()
@@ -84,15 +212,67 @@ if __name__ == "__main__":
     msg['Date'] = date
     msg.set_payload(args.body)
 
-    ## send mail
-    print(msg)
-    ok, ans = sendlib.smtp_send(s, msg, args.verbose)
-    if not ok: error("send", ans)
+    ## check attachments before connecting
+    for path in args.attach:
+        if not os.path.isfile(path): error("attach", f"{path}: no such file")
+
+    def send(s):
+        if not args.attach:
+            return sendlib.smtp_send(s, msg, args.verbose, args.deadline)
+        # streamed, the attachments are encoded while they are sent
+        import mimelib
+        headers = [(name, msg[name]) for name in ('From', 'To', 'Subject', 'Date')]
+        return mimelib.mime_send(s, args.sender, args.recipient, headers, args.body, args.attach,
+                                 args.verbose, args.deadline)
+
+    if pool is None:
+        s = open_session(args)
+
+        ## send mail
+        print(msg)
+        ok, ans, sent = send(s)
+        if not ok: error("send", ans)
+
+        # quit
+        ok, ans = sendlib.smtp_quit(s, args.verbose)
+        if not ok: error("quit", ans)
+        s.close()
+    else:
+        import senddaemon
+
+        ## send mail on a warm session, retry once on a fresh one if the connection was lost,
+        ## but only before DATA was accepted: later, the message may have been delivered
+        s, warm = senddaemon.pool_get(pool, args, open_session)
+        print(msg)
+        ok, ans, sent = send(s)
+        if not ok and warm and not sent and sendlib.smtp_code(ans) is None:
+            senddaemon.pool_drop(pool, s)
+            s, warm = senddaemon.pool_get(pool, args, open_session)
+            ok, ans, sent = send(s)
+        if not ok:
+            senddaemon.pool_drop(pool, s)
+            error("send", ans)
+        senddaemon.pool_put(pool, args, s)
 
-    # quit
-    ok, ans = sendlib.smtp_quit(s, args.verbose)
-    if not ok: error("quit", ans)
-    s.close()
     print("[Success]")
 
+###############################################
+
+if __name__ == "__main__":
+
+    argv = sys.argv[1:]
+
+    ## daemon mode
+    if '--daemon' in argv:
+        import senddaemon
+        senddaemon.daemon_serve(DAEMON_SOCKET, '-v' in argv or '--verbose' in argv)
+        sys.exit(0)
+
+    ## client mode: let a running daemon send the mail
+    if '--no-daemon' not in argv:
+        code = handoff(argv, DAEMON_SOCKET)
+        if code is not None: sys.exit(code)
+
+    main(argv)
+
 ### EOF
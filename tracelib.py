@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+# Module: tracelib.py
+# Copyright: University of Bordeaux, France (2023).
+
+import os
+import time
+import struct
+import threading
+
+###############################################
+###                DEFAULT                  ###
+###############################################
+
+MAGIC = b"STRC"
+VERSION = 2
+
+# file layout: MAGIC | version (u8) | protocol (4 bytes) | records
+# record layout: kind (u8) | session (u32) | time since connect (f64) | length (u32) | data
+HEADER = struct.Struct("<4sB4s")
+RECORD = struct.Struct("<BIdI")
+RECORDS = {1: struct.Struct("<BHdI"), VERSION: RECORD}     # version 1: 16-bit session ids
+
+CONNECT = 0     # data: "host:port"
+SEND = 1        # data: bytes sent by the client
+RECV = 2        # data: bytes received by the client
+CLOSE = 3
+ERROR = 4       # data: the error (e.g. a timeout)
+PAYLOAD = 5     # data: PAYLOAD_INFO of a chunk of message sent after DATA (the message is not kept)
+START = 6       # data: START_INFO, recorded after CONNECT (the sessions of a file may overlap)
+KINDS = {CONNECT: 'connect', SEND: 'send', RECV: 'recv', CLOSE: 'close', ERROR: 'error', PAYLOAD: 'payload',
+         START: 'start'}
+
+# payload info: bytes (u64) | lines (u64) | last chunk of the message (u8)
+PAYLOAD_INFO = struct.Struct("<QQB")
+
+# start info: wall-clock time of the connection (f64, time.time())
+START_INFO = struct.Struct("<d")
+
+# commands whose argument is a secret, masked in the transcript
+SECRETS = (b'AUTH ', b'PASS ')
+
+_files = {}
+_lock = threading.Lock()
+
+###############################################
+###                RECORD                   ###
+###############################################
+
+def _open(path, proto):
+    # one file per path, shared by the sessions (and threads) recording to it
+    with _lock:
+        if path not in _files:
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            if not new:
+                with open(path, 'rb') as f:
+                    _, record = _header(f, path)
+                if record is not RECORD:
+                    raise ValueError(f"{path}: older transcript version, record in a new file")
+            f = open(path, 'ab')
+            if new:
+                f.write(HEADER.pack(MAGIC, VERSION, proto.encode()[:4].ljust(4)))
+                f.flush()
+            _files[path] = {'file': f, 'sessions': _count(path) if not new else 0}
+        entry = _files[path]
+        session = entry['sessions']
+        entry['sessions'] += 1
+        return entry['file'], session
+
+def _count(path):
+    # sessions already in the file, so that appended sessions get new ids
+    return max((session for kind, session, t, data in trace_records(path)), default=-1) + 1
+
+class TraceSocket:
+    """
+    A socket recording what goes through it (see trace_socket).
+    Anything that is not recorded is passed to the real socket.
+    """
+
+    def __init__(self, s, path, proto):
+        self.s = s
+        self.file, self.session = _open(path, proto)
+        self.start = time.monotonic()
+        self.wall = time.time()
+        self.command = b''      # last command sent
+        self.payload = False    # sending a message (after DATA and 354)
+        self.tail = b''         # end of the message sent so far
+
+    def _record(self, kind, data=b''):
+        t = time.monotonic() - self.start
+        with _lock:
+            self.file.write(RECORD.pack(kind, self.session, t, len(data)) + data)
+            self.file.flush()
+
+    def connect(self, address):
+        self.start = time.monotonic()
+        self.wall = time.time()
+        self.s.connect(address)
+        self._record(CONNECT, f"{address[0]}:{address[1]}".encode())
+        self._record(START, START_INFO.pack(self.wall))
+
+    def _sent(self, data):
+        data = bytes(data)
+        if self.payload:
+            # the size of the message is enough to replay it
+            self.tail = (self.tail + data[-5:])[-5:]
+            last = self.tail.endswith(b'\r\n.\r\n')
+            self._record(PAYLOAD, PAYLOAD_INFO.pack(len(data), data.count(b'\n'), last))
+            self.payload = not last
+            return
+        self.command = data[:4].upper()
+        # keep the length and the line ending, so that the replay still works
+        if data[:5].upper() in SECRETS:
+            end = len(data.rstrip(b'\r\n'))
+            data = data[:5] + b'*' * (end - 5) + data[end:]
+        self._record(SEND, data)
+
+    def send(self, data):
+        n = self.s.send(data)
+        self._sent(data[:n])
+        return n
+
+    def sendall(self, data):
+        self.s.sendall(data)
+        self._sent(data)
+
+    def recv(self, size, *flags):
+        try:
+            data = self.s.recv(size, *flags)
+        except OSError as e:
+            self._record(ERROR, str(e).encode())
+            raise
+        self._record(RECV, data)
+        if self.command == b'DATA' and data.startswith(b'354'):
+            self.payload = True
+            self.tail = b'\r\n'
+        return data
+
+    def close(self):
+        if self.file:
+            self._record(CLOSE)
+            self.file = None
+        self.s.close()
+
+    def __getattr__(self, name):
+        return getattr(self.s, name)
+
+def trace_socket(s, path, proto):
+    """
+    Records the session going through a socket in a transcript file.
+
+    Call it before connecting the socket. For a secure session, wrap the
+    SSL socket so that the commands and replies are recorded in clear.
+
+    Parameters:
+        - s (socket): The socket to record (not connected yet).
+        - path (str): The transcript file (sessions are appended to it).
+        - proto (str): The protocol ('SMTP' or 'POP3').
+
+    Returns:
+        - s (TraceSocket): A socket to use instead of s.
+    """
+    return TraceSocket(s, path, proto)
+
+###############################################
+###                 READ                    ###
+###############################################
+
+def _header(f, path):
+    # the protocol of the transcript and its record layout, None if the file is empty
+    head = f.read(HEADER.size)
+    if len(head) < HEADER.size:
+        return None, None
+    magic, version, proto = HEADER.unpack(head)
+    if magic != MAGIC or version not in RECORDS:
+        raise ValueError(f"{path}: not a transcript")
+    return proto.decode().strip(), RECORDS[version]
+
+def trace_records(path):
+    """
+    Reads a transcript file one record at a time, without loading it in memory.
+
+    Parameters:
+        - path (str): The transcript file.
+
+    Yields:
+        - kind (int): The record kind (CONNECT, SEND, RECV, CLOSE, ERROR, PAYLOAD, START).
+        - session (int): The session id.
+        - t (float): The time since the session connected, in seconds.
+        - data (bytes): The data of the record.
+    """
+    with open(path, 'rb') as f:
+        _, record = _header(f, path)
+        if record is None:
+            return
+        while True:
+            head = f.read(record.size)
+            if len(head) < record.size:
+                return
+            kind, session, t, length = record.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return  # truncated record
+            yield kind, session, t, data
+
+def trace_read(path):
+    """
+    Reads a transcript file.
+
+    Parameters:
+        - path (str): The transcript file.
+
+    Returns:
+        - proto (str): The protocol.
+        - sessions (dict): For each session id, the list of (kind, time, data).
+    """
+    with open(path, 'rb') as f:
+        proto, _ = _header(f, path)
+    sessions = {}
+    for kind, session, t, data in trace_records(path):
+        sessions.setdefault(session, []).append((kind, t, data))
+    return proto, sessions
+
+### EOF